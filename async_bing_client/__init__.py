@@ -1,3 +1,13 @@
 from .client import Bing_Client
 from .const import ConversationStyle
-from .type import Notice, Text, Response, Apology, SuggestRely, SourceAttribution, SearchResult, Image, Limit, NewChat
+from .type import Notice, Text, Response, Apology, SuggestRely, SourceAttribution, SearchResult, Image, Limit, NewChat, DeleteResult, TextEvent, NoticeEvent, \
+    SuggestRelyEvent, SourceAttributionEvent, ImageEvent, LimitEvent
+from .recorder import FrameRecorder
+from .breaker import CircuitBreaker, CircuitOpenError, BreakerEvent
+from .store import ChatStore, SQLiteChatStore, JSONChatStore
+from .pool import BingClientPool
+from .limiter import RateLimit, AdmissionTimeout
+from .cache import ImageCache, BlobCache, DrawCache
+from .imaging import ImageExecutor, ImageTooLarge
+from .response_cache import ResponseCache, MemoryResponseCache, SQLiteResponseCache
+from .utils import RetryBudget
@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+from contextlib import contextmanager
+from time import monotonic
+from typing import Callable, List, NamedTuple
+
+from loguru import logger
+
+from .utils import is_retryable
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# client按bing的接口分组使用的断路器
+BREAKER_GROUPS = ("create", "token", "history", "delete", "chathub", "images", "kblob")
+
+
+class BreakerEvent(NamedTuple):
+    name: str
+    old_state: str
+    new_state: str
+    time: float
+
+
+class CircuitOpenError(Exception):
+    """断路器处于打开状态,请求被直接拒绝,retry_after是距离允许试探请求的秒数"""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"Circuit '{name}' is open, retry after {retry_after:.1f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """单个接口分组的断路器:连续失败failure_threshold次后打开,期间的请求直接失败,
+    reset_timeout秒后进入半开状态放行最多half_open_max_calls个试探请求,试探成功则关闭,失败则重新打开"""
+
+    def __init__(
+            self,
+            name: str,
+            failure_threshold: int = 5,
+            reset_timeout: float = 30,
+            half_open_max_calls: int = 1,
+            is_failure: Callable[[BaseException], bool] = is_retryable,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.is_failure = is_failure
+        self.failures = 0
+        self.opened_at = 0.0
+        self.half_open_calls = 0
+        self.listeners: List[Callable[[BreakerEvent], None]] = []
+        self._state = CLOSED
+
+    @property
+    def state(self) -> str:
+        if self._state == OPEN and monotonic() - self.opened_at >= self.reset_timeout:
+            self._transition(HALF_OPEN)
+        return self._state
+
+    def add_listener(self, listener: Callable[[BreakerEvent], None]) -> None:
+        """注册状态变化的回调,每次状态变化时会收到一个BreakerEvent"""
+        self.listeners.append(listener)
+
+    def before_call(self) -> None:
+        state = self.state
+        if state == OPEN:
+            raise CircuitOpenError(
+                self.name, self.reset_timeout - (monotonic() - self.opened_at)
+            )
+        if state == HALF_OPEN:
+            if self.half_open_calls >= self.half_open_max_calls:
+                raise CircuitOpenError(self.name, 0)
+            self.half_open_calls += 1
+
+    def on_success(self) -> None:
+        self.failures = 0
+        if self._state != CLOSED:
+            self._transition(CLOSED)
+
+    def on_failure(self) -> None:
+        self.failures += 1
+        if self._state == HALF_OPEN or (
+                self._state == CLOSED and self.failures >= self.failure_threshold
+        ):
+            self.opened_at = monotonic()
+            self._transition(OPEN)
+
+    def on_cancel(self) -> None:
+        if self._state == HALF_OPEN and self.half_open_calls > 0:
+            self.half_open_calls -= 1
+
+    @contextmanager
+    def guard(self):
+        """包裹一次请求,按照请求结果更新断路器的状态,断路器打开时抛出CircuitOpenError"""
+        self.before_call()
+        try:
+            yield
+        except Exception as e:
+            if self.is_failure(e):
+                self.on_failure()
+            else:
+                self.on_success()
+            raise
+        except BaseException:
+            # 请求被取消时没有结果,只释放占用的试探名额,否则断路器会一直停在半开状态
+            self.on_cancel()
+            raise
+        else:
+            self.on_success()
+
+    def _transition(self, new_state: str) -> None:
+        old_state, self._state = self._state, new_state
+        self.half_open_calls = 0
+        if new_state == OPEN:
+            logger.warning(f"Circuit '{self.name}' opened after {self.failures} failures")
+        else:
+            logger.info(f"Circuit '{self.name}' is {new_state} now")
+        event = BreakerEvent(self.name, old_state, new_state, monotonic())
+        for listener in self.listeners:
+            try:
+                listener(event)
+            except Exception as e:
+                logger.error(f"Circuit listener failed: {e}")
@@ -0,0 +1,217 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import os
+from collections import OrderedDict
+from pathlib import Path
+from time import monotonic
+from typing import Any, Callable, Hashable, Tuple
+
+
+class LRUCache:
+    """按最近使用淘汰的内存缓存,条目总大小超过max_size或者超过ttl秒后被淘汰,
+    set时没有指定size的条目大小按1计算,条目被淘汰或移除时会调用on_evict(key, value)"""
+
+    def __init__(
+            self,
+            max_size: float,
+            ttl: float = None,
+            on_evict: Callable[[Hashable, Any], None] = None,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.size = 0
+        # key -> (value, size, 过期时间)
+        self._data: OrderedDict[Hashable, Tuple[Any, float, float]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, count=False) is not None
+
+    def get(self, key: Hashable, count: bool = True) -> Any:
+        entry = self._data.get(key)
+        if entry is not None and entry[2] < monotonic():
+            self.pop(key)
+            entry = None
+        if entry is None:
+            if count:
+                self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        if count:
+            self.hits += 1
+        return entry[0]
+
+    def set(self, key: Hashable, value: Any, size: float = 1, ttl: float = None) -> None:
+        """ttl可以覆盖这个条目的有效期"""
+        if size > self.max_size:
+            return
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+        ttl = ttl if ttl is not None else self.ttl
+        expires_at = monotonic() + ttl if ttl is not None else float("inf")
+        self._data[key] = (value, size, expires_at)
+        self.size += size
+        while self.size > self.max_size:
+            self.pop(next(iter(self._data)))
+
+    def pop(self, key: Hashable) -> Any:
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return None
+        self.size -= entry[1]
+        if self.on_evict is not None:
+            self.on_evict(key, entry[0])
+        return entry[0]
+
+    def clear(self) -> None:
+        self._data.clear()
+        self.size = 0
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._data),
+            "size": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class ImageCache:
+    """上传图片的内容寻址缓存,用图片内容的sha256作为key:
+    compressed缓存压缩后的base64(按字节数计算大小),blobs缓存kblob返回的blobId,
+    urls缓存图片链接的ETag和内容的sha256,下载时用If-None-Match验证"""
+
+    def __init__(
+            self,
+            max_bytes: int = 64 * 1024 * 1024,
+            max_blobs: int = 1024,
+            ttl: float = 24 * 3600,
+    ):
+        self.compressed = LRUCache(max_bytes, ttl)
+        self.blobs = LRUCache(max_blobs, ttl)
+        self.urls = LRUCache(max_blobs, ttl)
+
+    @staticmethod
+    def digest(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def stats(self) -> dict:
+        return {
+            "compressed": self.compressed.stats(),
+            "blobs": self.blobs.stats(),
+            "urls": self.urls.stats(),
+        }
+
+
+class DrawCache:
+    """画图结果的缓存,key是规范化(忽略大小写和多余的空白)后的prompt,
+    图片列表保存ttl秒,Apology保存apology_ttl秒,取出的是结果的副本"""
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 6 * 3600, apology_ttl: float = 300):
+        self.results = LRUCache(max_entries, ttl)
+        self.apology_ttl = apology_ttl
+
+    @staticmethod
+    def normalize(prompt: str) -> str:
+        return " ".join(prompt.casefold().split())
+
+    def get(self, prompt: str) -> Any:
+        result = self.results.get(self.normalize(prompt))
+        return self._copy(result) if result is not None else None
+
+    def set(self, prompt: str, result: Any) -> None:
+        self.results.set(
+            self.normalize(prompt),
+            self._copy(result),
+            ttl=None if isinstance(result, list) else self.apology_ttl,
+        )
+
+    @staticmethod
+    def _copy(result: Any) -> Any:
+        if isinstance(result, list):
+            return [image.copy() for image in result]
+        return result.copy()
+
+
+class BlobCache:
+    """以内容的sha256为key保存图片等二进制内容,同时记录链接对应的sha256,
+    没有设置directory时保存在内存中,设置了directory时保存为其中的文件(重启后仍然有效),
+    总大小超过max_bytes时淘汰最久没有使用的内容"""
+
+    def __init__(self, max_bytes: int = 128 * 1024 * 1024, directory: str | Path = None):
+        self.directory = Path(directory) if directory is not None else None
+        self.blobs = LRUCache(max_bytes, on_evict=self._remove_file if self.directory else None)
+        self.urls = LRUCache(16384)
+        if self.directory is not None:
+            self._load_directory()
+
+    async def get(self, url: str) -> bytes | None:
+        digest = self.urls.get(url)
+        if digest is None:
+            return None
+        data = self.blobs.get(digest)
+        if data is None or self.directory is None:
+            return data
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                None, self._path(digest).read_bytes
+            )
+        except FileNotFoundError:
+            self.blobs.pop(digest)
+            return None
+
+    async def put(self, url: str, data: bytes, digest: str = None) -> str:
+        digest = digest or hashlib.sha256(data).hexdigest()
+        if self.blobs.get(digest, count=False) is None:
+            if self.directory is not None:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self._write_file, url, digest, data
+                )
+                self.blobs.set(digest, True, len(data))
+            else:
+                self.blobs.set(digest, data, len(data))
+        self.urls.set(url, digest)
+        return digest
+
+    def _path(self, digest: str) -> Path:
+        return self.directory / digest[:2] / digest
+
+    def _write_file(self, url: str, digest: str, data: bytes) -> None:
+        path = self._path(digest)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(path.name + ".tmp")
+        temp_path.write_bytes(data)
+        os.replace(temp_path, path)
+        # 链接和sha256的对应关系也保存下来,重启后可以继续使用
+        url_path = self.directory / "urls" / hashlib.sha256(url.encode()).hexdigest()
+        url_path.parent.mkdir(parents=True, exist_ok=True)
+        url_path.write_text(f"{url}\n{digest}", encoding="utf-8")
+
+    def _remove_file(self, digest: str, _) -> None:
+        try:
+            self._path(digest).unlink()
+        except FileNotFoundError:
+            pass
+
+    def _load_directory(self) -> None:
+        files = [
+            (path.stat().st_mtime, path)
+            for path in self.directory.glob("??/*")
+            if not path.name.endswith(".tmp")
+        ]
+        for _, path in sorted(files):
+            self.blobs.set(path.name, True, path.stat().st_size)
+        for path in self.directory.glob("urls/*"):
+            url, _, digest = path.read_text(encoding="utf-8").partition("\n")
+            if self.blobs.get(digest, count=False) is not None:
+                self.urls.set(url, digest)
+            else:
+                path.unlink()
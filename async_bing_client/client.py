@@ -1,21 +1,43 @@
 from __future__ import annotations
 
 import asyncio
+import base64
 import json
 import ssl
 import urllib.parse
 import uuid
-from json import JSONDecodeError
+from functools import partial
 from pathlib import Path
-from time import time
-from typing import List, Literal, AsyncGenerator, Any
+from time import time, monotonic
+from typing import List, Literal, AsyncGenerator, Any, Callable, Dict, Optional, Set, Tuple
 
 import aiohttp
 import certifi
 from loguru import logger
 from regex import regex
 
-from .const import HEADERS, WSSHEADERS, ConversationStyle, DELETE_HEADERS, DRAW_HEADERS
+from .const import (
+    HEADERS,
+    WSSHEADERS,
+    ConversationStyle,
+    DELETE_HEADERS,
+    DRAW_HEADERS,
+    HANDSHAKE_MESSAGE,
+    PING_MESSAGE,
+    CLOSE_MESSAGE,
+    TOKEN_TTL,
+    DRAW_POLL_INTERVAL,
+    DRAW_POLL_MAX_INTERVAL,
+)
+from .cache import ImageCache, BlobCache, DrawCache
+from .imaging import ImageExecutor
+from .breaker import CircuitBreaker, CircuitOpenError, BreakerEvent, BREAKER_GROUPS
+from .conversation_pool import ConversationPool
+from .recorder import FrameRecorder
+from .refresher import TokenRefresher
+from .limiter import RateLimit, RateLimiter, AdmissionTimeout
+from .store import ChatStore
+from .response_cache import ResponseCache, CACHED_EVENTS
 from .type import (
     Notice,
     Text,
@@ -27,14 +49,29 @@ from .type import (
     Image,
     Limit,
     NewChat,
+    DeleteResult,
+    TextEvent,
+    NoticeEvent,
+    SuggestRelyEvent,
+    SourceAttributionEvent,
+    ImageEvent,
+    LimitEvent,
 )
 from .utils import (
     process_cookie,
-    append_identifier,
-    build_chat_request,
+    build_chat_frame,
     guess_locale,
     async_retry,
     parse_proxy_url,
+    TextDeltaDecoder,
+    codec,
+    check_response,
+    BingHTTPError,
+    parse_retry_after,
+    RetryBudget,
+    SingleFlight,
+    single_flight,
+    read_image,
 )  # noqa: E501
 
 ssl_context = ssl.create_default_context()
@@ -43,7 +80,32 @@ ssl_context.load_verify_locations(certifi.where())
 
 class Bing_Client:
     def __init__(
-            self, cookie: str | Path | List[dict], proxy=None, wss_link: str = None
+            self,
+            cookie: str | Path | List[dict],
+            proxy=None,
+            wss_link: str = None,
+            limit: int = 100,
+            limit_per_host: int = 20,
+            keepalive_timeout: float = 30,
+            ttl_dns_cache: int = 300,
+            recorder: FrameRecorder = None,
+            heartbeat_interval: float = 6,
+            retry_budget: RetryBudget = None,
+            breaker_failure_threshold: int = 5,
+            breaker_reset_timeout: float = 30,
+            on_breaker_change: Callable[[BreakerEvent], Any] = None,
+            store: ChatStore = None,
+            rate_limits: Dict[str, RateLimit] = None,
+            warm_chats: int = 0,
+            warm_chats_min_ttl: float = 600,
+            refresh_tokens: bool = False,
+            image_cache: ImageCache = None,
+            image_executor: ImageExecutor = None,
+            max_concurrent_draws: int = 2,
+            draw_timeout: float = 300,
+            blob_cache: BlobCache = None,
+            draw_cache: DrawCache = None,
+            response_cache: ResponseCache = None,
     ):
         self.chats: dict = {}
         self.client_id: str = ""
@@ -51,58 +113,320 @@ class Bing_Client:
         self.cookie_jar = process_cookie(cookie)
         self.proxy = parse_proxy_url(proxy) if proxy else None
         self.wss_link = wss_link
+        self.connector_options = {
+            "limit": limit,
+            "limit_per_host": limit_per_host,
+            "keepalive_timeout": keepalive_timeout,
+            "ttl_dns_cache": ttl_dns_cache,
+        }
+        self._session: aiohttp.ClientSession | None = None
+        self._image_session: aiohttp.ClientSession | None = None
+        self.recorder = recorder
+        self.heartbeat_interval = heartbeat_interval
+        self.retry_budget = retry_budget or RetryBudget()
+        self.store = store
+        # 相同内容的图片不再重复压缩和上传,设置为None可以关闭
+        self.image_cache = image_cache if image_cache is not None else ImageCache()
+        # 压缩图片使用的执行器,不占用事件循环默认的线程池
+        self.image_executor = image_executor or ImageExecutor()
+        # 同时进行的画图最多max_concurrent_draws个,每次画图最多draw_timeout秒
+        self.max_concurrent_draws = max_concurrent_draws
+        self.draw_timeout = draw_timeout
+        self._draw_semaphore: Optional[asyncio.Semaphore] = None
+        self._draw_tasks: Set[asyncio.Task] = set()
+        # prepare()预先建立的ChatHub连接: 会话id -> (连接, 过期时间)
+        self._prepared: Dict[str, tuple] = {}
+        # 下载过的画图结果,按内容的sha256保存
+        self.blob_cache = blob_cache if blob_cache is not None else BlobCache()
+        # 设置后相同prompt的画图直接使用缓存的结果,正在进行的相同画图会被合并
+        self.draw_cache = draw_cache
+        # 设置后首轮且没有图片的对话会重放缓存的回复
+        self.response_cache = response_cache
+        # 合并相同的并发请求(获取token,聊天记录,会话列表)
+        self.flights = SingleFlight()
+        # 可以限制的接口: chat(每轮对话), create(创建对话), draw(画图), delete(删除对话)
+        self.limiters = {
+            name: RateLimiter(name, limit) for name, limit in (rate_limits or {}).items()
+        }
+        self.breakers = {
+            name: CircuitBreaker(name, breaker_failure_threshold, breaker_reset_timeout)
+            for name in BREAKER_GROUPS
+        }
+        if on_breaker_change:
+            for breaker in self.breakers.values():
+                breaker.add_listener(on_breaker_change)
+        # 预先创建的对话,warm_chats为0时不启用
+        self.conversation_pool = (
+            ConversationPool(self, warm_chats, warm_chats_min_ttl) if warm_chats else None
+        )
+        # refresh_tokens为True时在后台提前刷新活跃会话的token
+        self.token_refresher = TokenRefresher(self)
+        self.refresh_tokens = refresh_tokens
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.aclose()
 
     @property
     def chat_list(self):
         return [{key: value} for key, value in self.chats.items()]
 
-    async def init(self):
-        """初始化bing client"""
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """client共享的连接池会话,所有的http和wss请求都复用它,第一次使用时创建"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(ssl=ssl_context, **self.connector_options)
+            self._session = aiohttp.ClientSession(
+                cookie_jar=self.cookie_jar, connector=connector
+            )
+        return self._session
+
+    @property
+    def image_session(self) -> aiohttp.ClientSession:
+        """下载用户传入的图片链接和画图结果用的会话,和session共用连接池,但是不使用也不保存cookie,
+        避免第三方网站设置的cookie进入cookie_jar后被发送给bing"""
+        if self._image_session is None or self._image_session.closed:
+            self._image_session = aiohttp.ClientSession(
+                connector=self.session.connector,
+                connector_owner=False,
+                cookie_jar=aiohttp.DummyCookieJar(),
+            )
+        return self._image_session
+
+    async def aclose(self):
+        """关闭client的连接池,后台任务和持久化存储"""
+        self.cancel_draws()
+        for wss, _ in self._prepared.values():
+            await wss.close()
+        self._prepared.clear()
+        if self.conversation_pool is not None:
+            await self.conversation_pool.close()
+        await self.token_refresher.close()
+        self.image_executor.close()
+        if self._image_session is not None and not self._image_session.closed:
+            await self._image_session.close()
+        self._image_session = None
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        if self.store is not None:
+            await self.store.close()
+        if self.response_cache is not None:
+            await self.response_cache.close()
+
+    async def _admit(self, name: str, priority: int = 0, max_wait: float = None) -> None:
+        """按照rate_limits中对应接口的限制排队等待"""
+        limiter = self.limiters.get(name)
+        if limiter is not None:
+            await limiter.acquire(priority, max_wait)
+
+    def rate_limit_stats(self) -> Dict[str, dict]:
+        """各个接口准入队列的长度和等待时间,可以用于扩缩容"""
+        return {name: limiter.stats() for name, limiter in self.limiters.items()}
+
+    def _save_chat(self, conversation_id: str) -> None:
+        """把会话的变化写入持久化存储(如果有),写入在后台进行"""
+        if self.store is not None and conversation_id in self.chats:
+            self.store.put_chat(conversation_id, self.chats[conversation_id])
+
+    async def init(
+            self,
+            lazy: bool = False,
+            concurrency: int = 8,
+            progress: Callable[[int, int], Any] = None,
+            refresh: bool = False,
+    ):
+        """初始化bing client,lazy为True时只拉取会话列表,每个会话的access_token在第一次使用时才获取,
+        设置了store时会直接使用保存的会话和access_token,refresh为True时才重新从bing拉取"""
         logger.info("creating Bing Client - - -.")
+        if self.store is not None and not refresh:
+            client_id, chats = await self.store.load()
+            if client_id and chats:
+                self.client_id, self.chats = client_id, chats
+                logger.info("Succeed to load Bing Client from store.")
+                self._start_background_tasks()
+                return self
         await self.get_chats()
-        await self.load_all_chats(load_history=False)
+        if not lazy:
+            await self.load_all_chats(
+                load_history=False, concurrency=concurrency, progress=progress
+            )
+        self._start_background_tasks()
         logger.info("Succeed to creat Bing Client.")
         return self
 
-    @async_retry(10)
-    async def create_chat(self):
-        """创建一个新的对话,返回一个包含新对话信息的dict,可以直接传入到ask_stream中进行使用"""
-        async with aiohttp.ClientSession(cookie_jar=self.cookie_jar) as session:
-            async with session.get(
-                    "https://www.bing.com/turing/conversation/create",
-                    headers=HEADERS,
-                    proxy=self.proxy,
-            ) as response:
+    def _start_background_tasks(self) -> None:
+        if self.conversation_pool is not None:
+            self.conversation_pool.start()
+        if self.refresh_tokens:
+            self.token_refresher.start()
+
+    async def create_chat(self, priority: int = 0, max_wait: float = None):
+        """创建一个新的对话,返回一个包含新对话信息的dict,可以直接传入到ask_stream中进行使用,
+        启用了warm_chats时优先取出预先创建好的对话"""
+        new_chat = None
+        if self.conversation_pool is not None:
+            self.conversation_pool.start()
+            new_chat = self.conversation_pool.take()
+        if new_chat is None:
+            await self._admit("create", priority, max_wait)
+            new_chat = await self._request_new_chat()
+        conversation_id = list(new_chat.keys())[0]
+        self.chats = {**new_chat, **self.chats}
+        self._save_chat(conversation_id)
+        return new_chat
+
+    @async_retry(10, breaker="create")
+    async def _request_new_chat(self) -> dict:
+        """向bing请求创建一个新的对话(带access_token),不会加入到chats中"""
+        async with self.session.get(
+                "https://www.bing.com/turing/conversation/create",
+                headers=HEADERS,
+                proxy=self.proxy,
+        ) as response:
+            await check_response(response)
+            try:
+                data = await response.json()
+                access_token = response.headers.get(
+                    "X-Sydney-EncryptedConversationSignature"
+                )
+                if access_token:
+                    data["access_token"] = urllib.parse.quote(access_token, safe="")
+                new_chat = {data["conversationId"]: {**data, "time": time()}}
+                logger.info("Succeed to creat new chat")
+                return new_chat
+            except Exception:
+                error = await response.text()
+                raise Exception(error)
+
+    async def draw(
+            self,
+            prompt: str,
+            priority: int = 0,
+            max_wait: float = None,
+            download: bool = False,
+    ) -> List[Image] | Apology:
+        """按照传入的prompt进行绘图,这个功能可以直接在ask_stream中被自动调用并返回图片或bing的apology
+        同时最多进行max_concurrent_draws个画图,超出的会等待,超过draw_timeout秒没有画完时返回Apology
+        download为True时会同时下载所有图片并填入Image.base64,设置了draw_cache时相同的prompt会使用缓存的结果"""
+        try:
+            if self.draw_cache is None:
+                result = await self._generate(prompt, priority, max_wait)
+            else:
+                result = self.draw_cache.get(prompt)
+                if result is None:
+                    # 所有等待这个prompt的调用方都被取消时(关闭对话或cancel_draws)同时取消画图
+                    result = await self.flights.do(
+                        ("draw", self.draw_cache.normalize(prompt)),
+                        partial(self._start_draw_flight, prompt, priority, max_wait),
+                        cancel_abandoned=True,
+                    )
+                    result = self.draw_cache.get(prompt) or result
+        except (CircuitOpenError, AdmissionTimeout) as e:
+            return Apology(content=f"Drawing Failed: {e}")
+        if download and isinstance(result, list):
+            await self.download_images(result)
+        return result
+
+    async def _generate(
+            self, prompt: str, priority: int = 0, max_wait: float = None
+    ) -> List[Image] | Apology:
+        # draw_timeout包括排队,创建画图请求和查询结果的全部时间
+        deadline = monotonic() + self.draw_timeout
+        try:
+            return await asyncio.wait_for(
+                self._generate_until(prompt, deadline, priority, max_wait),
+                self.draw_timeout,
+            )
+        except asyncio.TimeoutError:
+            if monotonic() < deadline:
+                # 单个请求超时,不是总时间用完
+                raise
+            return Apology(content=f"Drawing Failed: No result after {self.draw_timeout:.0f}s")
+
+    async def _generate_until(
+            self, prompt: str, deadline: float, priority: int = 0, max_wait: float = None
+    ) -> List[Image] | Apology:
+        if self._draw_semaphore is None:
+            self._draw_semaphore = asyncio.Semaphore(self.max_concurrent_draws)
+        await self._admit("draw", priority, max_wait)
+        async with self._draw_semaphore:
+            with self.breakers["images"].guard():
+                return await self._draw(prompt, deadline)
+
+    async def _generate_and_cache(
+            self, prompt: str, priority: int = 0, max_wait: float = None
+    ) -> List[Image] | Apology:
+        result = await self._generate(prompt, priority, max_wait)
+        self.draw_cache.set(prompt, result)
+        return result
+
+    def _start_draw_flight(
+            self, prompt: str, priority: int = 0, max_wait: float = None
+    ) -> asyncio.Task:
+        task = asyncio.create_task(self._generate_and_cache(prompt, priority, max_wait))
+        self._draw_tasks.add(task)
+        task.add_done_callback(self._draw_tasks.discard)
+        return task
+
+    def submit_draw(
+            self,
+            prompt: str,
+            priority: int = 0,
+            max_wait: float = None,
+            download: bool = False,
+    ) -> asyncio.Task:
+        """在后台开始画图,返回可以等待或取消的task,cancel_draws会取消所有还没有完成的画图(包括共享的画图)"""
+        task = asyncio.create_task(self.draw(prompt, priority, max_wait, download))
+        self._draw_tasks.add(task)
+        task.add_done_callback(self._draw_tasks.discard)
+        return task
+
+    async def download_images(self, images: List[Image]) -> List[Image]:
+        """同时下载所有图片并填入Image.base64,下载过的图片直接从blob_cache中读取,下载失败的图片保持不变"""
+
+        async def download(image: Image):
+            data = await self.blob_cache.get(image.url)
+            if data is None:
                 try:
-                    data = await response.json()
-                    access_token = response.headers.get(
-                        "X-Sydney-EncryptedConversationSignature"
+                    data, digest = await read_image(
+                        image.url,
+                        self.image_session,
+                        self.proxy,
+                        max_bytes=self.image_executor.max_input_bytes,
                     )
-                    if access_token:
-                        data["access_token"] = urllib.parse.quote(access_token, safe="")
-                    new_chat = {data["conversationId"]: {**data, "time": time()}}
-                    logger.info("Succeed to creat new chat")
-                    self.chats = {**new_chat, **self.chats}
-                    return new_chat
-                except Exception:
-                    error = await response.text()
-                    raise Exception(error)
-
-    async def draw(self, prompt: str) -> List[Image] | Apology:
-        """按照传入的prompt进行绘图,这个功能可以直接在ask_stream中被自动调用并返回图片或bing的apology"""
+                except Exception as e:
+                    logger.error(f"Failed to download image:{image.url}: {e}")
+                    return
+                await self.blob_cache.put(image.url, data, digest)
+            image.base64 = base64.b64encode(data).decode("utf-8")
+
+        await asyncio.gather(*[download(image) for image in images])
+        return images
+
+    def cancel_draws(self) -> None:
+        for task in list(self._draw_tasks):
+            task.cancel()
+
+    async def _draw(self, prompt: str, deadline: float = None) -> List[Image] | Apology:
         url_encoded_prompt = urllib.parse.quote(f"prompt='{prompt}'")
+        if deadline is None:
+            deadline = monotonic() + self.draw_timeout
 
-        timeout = aiohttp.ClientTimeout(total=60)
-        async with aiohttp.ClientSession(
-                cookie_jar=self.cookie_jar,
-                headers=DRAW_HEADERS,
-                timeout=timeout,
-        ) as session:
-            response = await session.get(
+        def request_timeout() -> aiohttp.ClientTimeout:
+            # 每个请求最多60秒,并且不超过剩余的时间
+            return aiohttp.ClientTimeout(total=max(min(60.0, deadline - monotonic()), 1))
+
+        session = self.session
+        async with session.get(
                 url=f"https://www.bing.com/images/create?partner=sydney&re=1&showselective=1&sude=1&kseed=8000&SFX=3&q={url_encoded_prompt}&iframeid={uuid.uuid4()}",
+                headers=DRAW_HEADERS,
+                timeout=request_timeout(),
                 allow_redirects=False,
                 proxy=self.proxy,
-            )
+        ) as response:
             if response.status != 302:
                 return Apology(content="Drawing Failed: Redirect failed")
             resp_text = await response.text()
@@ -111,22 +435,27 @@ class Bing_Client:
                     content="Your prompt has been blocked by Bing. Try to change any bad words and try again."
                 )
             redirect_url = f"https://www.bing.com{response.headers['Location']}"
-            response = await session.get(
+        async with session.get(
                 redirect_url,
+                headers=DRAW_HEADERS,
+                timeout=request_timeout(),
                 allow_redirects=False,
                 proxy=self.proxy,
-            )
+        ) as response:
             resp_text = await response.text()
             if "blocked" in resp_text:
                 return Apology(
                     content="Your prompt has been blocked by Bing. Try to change any bad words and try again."
                 )
-            if response.status != 302:
-                response = await session.get(
+            status, location = response.status, response.headers.get("Location", "")
+        if status != 302:
+            async with session.get(
                     redirect_url.replace("rt=4", "rt=3"),
+                    headers=DRAW_HEADERS,
+                    timeout=request_timeout(),
                     allow_redirects=False,
                     proxy=self.proxy,
-                )
+            ) as response:
                 resp_text = await response.text()
                 if "blocked" in resp_text:
                     return Apology(
@@ -134,36 +463,50 @@ class Bing_Client:
                     )
                 if response.status != 302:
                     return Apology(content="Drawing Failed: Redirect failed")
+                location = response.headers["Location"]
 
-            request_id = response.headers["Location"].split("id=")[-1]
+        request_id = location.split("id=")[-1]
 
-            polling_url = f"https://www.bing.com/images/create/async/results/{request_id}?q={url_encoded_prompt}"
+        polling_url = f"https://www.bing.com/images/create/async/results/{request_id}?q={url_encoded_prompt}"
 
-            while True:
-                response = await session.get(polling_url, proxy=self.proxy)
+        # 结果还没有生成时,按服务器给出的Retry-After或者逐渐变长的间隔查询,总时间不超过draw_timeout
+        interval = DRAW_POLL_INTERVAL
+        while True:
+            async with session.get(
+                    polling_url,
+                    headers=DRAW_HEADERS,
+                    timeout=request_timeout(),
+                    proxy=self.proxy,
+            ) as response:
                 if response.status != 200:
                     return Apology(content="Drawing Failed: Could not get results")
                 content = await response.text()
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
 
-                if content:
-                    break
-                else:
-                    await asyncio.sleep(1)
+            if content:
+                break
+            delay = retry_after if retry_after is not None else interval
+            if monotonic() + delay > deadline:
+                return Apology(
+                    content=f"Drawing Failed: No result after {self.draw_timeout:.0f}s"
+                )
+            await asyncio.sleep(delay)
+            interval = min(interval * 1.5, DRAW_POLL_MAX_INTERVAL)
 
-            image_links = regex.findall(r'src="([^"]+)"', content)
+        image_links = regex.findall(r'src="([^"]+)"', content)
 
-            normal_image_links = [link.split("?w=")[0] for link in image_links]
+        normal_image_links = [link.split("?w=")[0] for link in image_links]
 
-            normal_image_links = list(set(normal_image_links))
-            normal_image_links = [
-                link for link in normal_image_links if "r.bing.com" not in link
-            ]
-            if not normal_image_links:
-                return Apology(content="Drawing Failed: No images are found.")
-            result_images = []
-            for index, image in enumerate(normal_image_links):
-                result_images.append(Image(name=f"img{index + 1}.png", url=image))
-            return result_images
+        normal_image_links = list(set(normal_image_links))
+        normal_image_links = [
+            link for link in normal_image_links if "r.bing.com" not in link
+        ]
+        if not normal_image_links:
+            return Apology(content="Drawing Failed: No images are found.")
+        result_images = []
+        for index, image in enumerate(normal_image_links):
+            result_images.append(Image(name=f"img{index + 1}.png", url=image))
+        return result_images
 
     async def ask_stream(
             self,
@@ -182,19 +525,25 @@ class Bing_Client:
         images = []
         limit = None
         async for data in self.ask_stream_raw(
-                question, image, chat, conversation_style, personality, locale=locale
+                question,
+                image,
+                chat,
+                conversation_style,
+                personality,
+                locale=locale,
+                fast_events=True,
         ):
-            if isinstance(data, Text):
+            if isinstance(data, (Text, TextEvent)):
                 yield data.content
-            elif isinstance(data, SuggestRely):
+            elif isinstance(data, (SuggestRely, SuggestRelyEvent)):
                 suggest_reply.append(data)
-            elif isinstance(data, SourceAttribution):
+            elif isinstance(data, (SourceAttribution, SourceAttributionEvent)):
                 sources.append(data)
             elif isinstance(data, Apology):
                 yield "\n" + data.content
             elif isinstance(data, Image):
                 images.append(data)
-            elif isinstance(data, Limit):
+            elif isinstance(data, (Limit, LimitEvent)):
                 limit = data
             elif isinstance(data, SearchResult) and yield_search:
                 yield str(data)
@@ -223,6 +572,23 @@ class Bing_Client:
             chat_data = list(chat.values())[0]
         return chat_data
 
+    async def ensure_token(self, chat: dict) -> dict:
+        """在需要时获取或刷新会话的access_token(从没获取过,超过TOKEN_TTL,或者会话没有conversationSignature),
+        返回最新的chat_data,启用了refresh_tokens时活跃会话的token通常已经在后台刷新好了"""
+        chat_data = self.get_chatdata(chat)
+        if self.refresh_tokens:
+            self.token_refresher.track(chat_data["conversationId"])
+        token_time = chat_data.get("time")
+        conversation_signature = chat_data.get("conversationSignature", "")
+        if (
+                not token_time
+                or time() - token_time > TOKEN_TTL
+                or not conversation_signature
+        ):
+            await self.get_token(chat_data["conversationId"])
+            chat_data = self.get_chatdata(chat)
+        return chat_data
+
     async def ask_stream_raw(
             self,
             question: str,
@@ -231,6 +597,10 @@ class Bing_Client:
             conversation_style: ConversationStyle = ConversationStyle.Creative,
             personality=None,
             locale=guess_locale(),
+            fast_events: bool = False,
+            priority: int = 0,
+            max_wait: float = None,
+            download: bool = False,
     ) -> AsyncGenerator[
         NewChat
         | Apology
@@ -243,76 +613,136 @@ class Bing_Client:
         | Response
         | Any
         ]:
-        """返回原始数据类型的流式对话生成器,返回的类型请在type中自行查看"""
+        """返回原始数据类型的流式对话生成器,返回的类型请在type中自行查看
+        fast_events为True时,Text,Notice,SuggestRely,SourceAttribution,Limit会以不经过pydantic校验的
+        轻量事件(TextEvent等)返回,需要模型时可以调用to_model()
+        设置了rate_limits时,超出限制的请求会按priority(越小越优先)排队,最多等待max_wait秒
+        download为True时画图得到的图片会被下载并填入Image.base64
+        设置了response_cache时,没有chat和image的首轮对话会优先重放缓存的回复(不会创建新的对话)"""
+        cache_key = None
+        if self.response_cache is not None and not chat and not image:
+            cache_key = self.response_cache.key(
+                question, conversation_style, locale, personality
+            )
+            cached = await self.response_cache.get(cache_key)
+            if cached is not None:
+                async for event in self.response_cache.replay(cached, fast_events):
+                    yield event
+                return
+        stream = self._ask_stream_raw(
+            question,
+            image,
+            chat,
+            conversation_style,
+            personality,
+            locale,
+            fast_events,
+            priority,
+            max_wait,
+            download,
+        )
+        # 只缓存正常结束,并且没有Apology和画图的回复
+        events = []
+        cacheable, completed = cache_key is not None, False
+        try:
+            async for event in stream:
+                if cacheable:
+                    if isinstance(event, CACHED_EVENTS):
+                        events.append(event)
+                    elif isinstance(event, Response):
+                        completed = True
+                    elif isinstance(event, (Apology, Image, ImageEvent)):
+                        cacheable = False
+                yield event
+        finally:
+            # 调用方提前停止迭代时,也要让对话的清理逻辑立即执行
+            await stream.aclose()
+        if cacheable and completed:
+            await self.response_cache.set(cache_key, events)
+
+    async def _ask_stream_raw(
+            self,
+            question: str,
+            image: str | Path | bytes = None,
+            chat: dict = None,
+            conversation_style: ConversationStyle = ConversationStyle.Creative,
+            personality=None,
+            locale=guess_locale(),
+            fast_events: bool = False,
+            priority: int = 0,
+            max_wait: float = None,
+            download: bool = False,
+    ) -> AsyncGenerator[Any, None]:
+        if fast_events:
+            text_type, notice_type, suggest_type, source_type, image_type, limit_type = (
+                TextEvent,
+                NoticeEvent,
+                SuggestRelyEvent,
+                SourceAttributionEvent,
+                ImageEvent,
+                LimitEvent,
+            )
+        else:
+            text_type, notice_type, suggest_type, source_type, image_type, limit_type = (
+                Text,
+                Notice,
+                SuggestRely,
+                SourceAttribution,
+                Image,
+                Limit,
+            )
+        await self._admit("chat", priority, max_wait)
         if not chat:
-            chat = await self.create_chat()
+            chat = await self.create_chat(priority, max_wait)
             yield NewChat(chat=chat)
 
         chat_data = self.get_chatdata(chat)
-
-        access_token = chat_data.get("access_token", "")
-        conversation_signature = chat_data.get("conversationSignature", "")
-        if access_token or (not conversation_signature):
-            if (not chat_data.get("time") or time() - chat_data.get("time") > 2500) or (
-                    not conversation_signature
-            ):
-                await self.get_token(chat_data["conversationId"])
-                self.chats[chat_data["conversationId"]]["time"] = time()
-                chat_data = self.get_chatdata(chat)
-
-            url = (
-                    (self.wss_link or "wss://sydney.bing.com/sydney/ChatHub")
-                    + "?sec_access_token="
-                    + chat_data.get("access_token", "")
+        # 图片的压缩和上传不依赖ChatHub连接,和建立连接同时进行
+        request_task = asyncio.create_task(
+            build_chat_frame(
+                self,
+                question,
+                chat_data,
+                conversation_style,
+                image,
+                personality,
+                locale,
             )
-
-        else:
-            url = self.wss_link or "wss://sydney.bing.com/sydney/ChatHub"
-        async with aiohttp.ClientSession(cookie_jar=self.cookie_jar) as session:
-            wss_headers = WSSHEADERS
-            if self.cookie_jar is not None:
-                wss_cookies = [f"{cookie.key}={cookie.value}" for cookie in self.cookie_jar]
-                wss_headers["cookie"] = ";".join(wss_cookies)
-            async with session.ws_connect(
-                    url=url, ssl=ssl_context, headers=wss_headers, proxy=self.proxy
-            ) as wss:
-                await wss.send_str(
-                    append_identifier({"protocol": "json", "version": 1})
-                )
-                await wss.receive_str()
-                await wss.send_str(append_identifier({"type": 6}))
-                data = await build_chat_request(
-                    self,
-                    question,
-                    chat_data,
-                    conversation_style,
-                    image,
-                    personality,
-                    locale,
-                )
-                await wss.send_str(append_identifier(data))
-                last_text = ""
+        )
+        frame_writer = heartbeat_task = receive_task = None
+        image_tasks = []
+        try:
+            wss = self._take_prepared(chat_data["conversationId"])
+            if wss is None:
+                chat_data = await self.ensure_token(chat)
+                wss = await self._connect(chat_data)
+            frame_writer = (
+                self.recorder.open(chat_data["conversationId"]) if self.recorder else None
+            )
+            async with wss:
+                await wss.send_str(PING_MESSAGE)
+                await wss.send_str(await request_task)
+                text_decoder = TextDeltaDecoder()
                 apology = ""
                 retry_count = 5
                 sas = []
-                image_tasks = []
-                store_data = []
+                heartbeat_task = asyncio.create_task(self._heartbeat(wss))
                 while not wss.closed:
-                    msg = await wss.receive(timeout=900)
-                    if image_tasks:
-                        for task in image_tasks:
-                            if task.done():
-                                image_tasks.remove(task)
-                                result = task.result()
-                                if isinstance(result, Apology):
-                                    yield result
-                                elif isinstance(result, list):
-                                    for image in result:
-                                        yield image
-
-                    # 心跳
-                    if int(time()) % 6 == 0:
-                        await wss.send_str(append_identifier({"type": 6}))
+                    if receive_task is None:
+                        receive_task = asyncio.ensure_future(wss.receive(timeout=900))
+                    # 同时等待下一帧和绘图任务,绘图完成后立即返回结果
+                    done, _ = await asyncio.wait(
+                        [receive_task, *image_tasks],
+                        return_when=asyncio.FIRST_COMPLETED,
+                    )
+                    for task in [task for task in image_tasks if task in done]:
+                        image_tasks.remove(task)
+                        for event in self._draw_result_events(task.result()):
+                            yield event
+                    if receive_task not in done:
+                        continue
+                    msg = receive_task.result()
+                    receive_task = None
 
                     # 设置错误上限次数
                     if not msg.data:
@@ -334,10 +764,9 @@ class Bing_Client:
                             continue
 
                         # 加载成json格式
-                        response = json.loads(obj)
-                        store_data.append(response)
-                        with open("data1.json", "w") as f:
-                            f.write(json.dumps(store_data))
+                        response = codec.loads(obj)
+                        if frame_writer is not None:
+                            frame_writer.write(obj)
                         # 用type来区分response的类型,并且只要bot发的消息,过滤掉
                         if (
                                 response.get("type") == 1
@@ -358,32 +787,27 @@ class Bing_Client:
                                 ):
                                     """Draw images"""
                                     image_tasks.append(
-                                        asyncio.create_task(
-                                            self.draw(message.get("text", ""))
+                                        self.submit_draw(
+                                            message.get("text", ""), download=download
                                         )
                                     )
                                 if (
                                         message.get("messageType")
                                         == "InternalLoaderMessage"
                                 ):  # noqa: E501
-                                    yield Notice(content=message.get("text", ""))
+                                    yield notice_type(content=message.get("text", ""))
                                 elif (
                                         message.get("messageType") == "InternalSearchResult"
                                 ):
-                                    try:
-                                        content = (
-                                            json.loads(
-                                                message.get(
-                                                    "text",
-                                                    message.get("hiddenText", "")
-                                                    .replace("```json", "")
-                                                    .replace("\n```", ""),
-                                                )
-                                            )
-                                        ).get("web_search_results", [])
-                                    except JSONDecodeError:
-                                        content = message.get("text", "")
-                                    yield SearchResult(content=content)
+                                    raw = message.get("text")
+                                    if raw is None:
+                                        raw = (
+                                            message.get("hiddenText", "")
+                                            .replace("```json", "")
+                                            .replace("\n```", "")
+                                        )
+                                    # 搜索结果只在读取content时才会解析
+                                    yield SearchResult(raw=raw)
                                 elif message["contentOrigin"] == "Apology":
                                     yield_text = message.get("text", "")[len(apology):]
                                     apology = message.get("text", "")
@@ -391,51 +815,25 @@ class Bing_Client:
                                         yield Apology(content=yield_text)
 
                                 elif "messageType" not in message.keys():
-                                    plain_text: str = message.get("text", "")
-                                    if plain_text.endswith(
-                                            (
-                                                    "[",
-                                                    "]",
-                                                    "(",
-                                                    ")",
-                                                    "^",
-                                                    "1",
-                                                    "2",
-                                                    "3",
-                                                    "4",
-                                                    "5",
-                                                    "6",
-                                                    "7",
-                                                    "8",
-                                                    "9",
-                                                    "0",
-                                            )
-                                    ):
+                                    yield_text = text_decoder.feed(message.get("text", ""))
+                                    if yield_text is None:
                                         continue
-                                    plain_text: str = (
-                                        plain_text.replace("[^", "[")
-                                        .replace("^]", "]")
-                                        .replace("(^", "(")
-                                        .replace("^)", ")")
-                                    )
-                                    yield_text = plain_text[len(last_text):]
-                                    last_text = plain_text
 
                                     if yield_text:
-                                        yield Text(content=yield_text)
+                                        yield text_type(content=yield_text)
 
                                     if (
                                             message.get("sourceAttributions")
                                             and message["sourceAttributions"]
                                     ):
                                         for sa in message.get("sourceAttributions", ""):
-                                            new_sa = SourceAttribution(
+                                            new_sa = source_type(
                                                 display_name=sa.get(
                                                     "providerDisplayName",
                                                     sa.get("seeMoreUrl", ""),
                                                 ),
                                                 see_more_url=sa.get("seeMoreUrl", ""),
-                                                image=Image(
+                                                image=image_type(
                                                     url=sa.get("imageLink", ""),
                                                     base64=sa.get("imageFavicon", ""),
                                                 ),
@@ -453,7 +851,7 @@ class Bing_Client:
                                         ):
                                             suggest = suggest_dict.get("text", "")
                                             if suggest:
-                                                yield SuggestRely(content=suggest)
+                                                yield suggest_type(content=suggest)
 
                                     else:
                                         continue
@@ -468,7 +866,7 @@ class Bing_Client:
                             limit = ((response.get("arguments", [{}]))[0]).get(
                                 "throttling", ""
                             )
-                            yield Limit(
+                            yield limit_type(
                                 max_num_user_messages=limit[
                                     "maxNumUserMessagesInConversation"
                                 ],
@@ -514,6 +912,7 @@ class Bing_Client:
                                     self.chats[chat_data["conversationId"]][
                                         "message"
                                     ].append(response["item"]["messages"])
+                                self._save_chat(chat_data["conversationId"])
                             except Exception as e:
                                 logger.error(
                                     f"Failed to add new messages to cache: {e}"
@@ -523,62 +922,162 @@ class Bing_Client:
                             break
                     if response.get("type") != 2:
                         if response.get("type") == 6:
-                            await wss.send_str(append_identifier({"type": 6}))
+                            await wss.send_str(PING_MESSAGE)
                         elif response.get("type") == 7:
-                            await wss.send_str(append_identifier({"type": 7}))
-
-                if image_tasks:
-                    results = await asyncio.gather(*image_tasks)
-                    for result in results:
-                        if isinstance(result, Apology):
-                            yield result
-                        elif isinstance(result, list):
-                            for image in result:
-                                yield image
-                        else:
-                            yield Apology(content="Unknown error when drawing.")
-
-    @async_retry(5)
+                            await wss.send_str(CLOSE_MESSAGE)
+
+                while image_tasks:
+                    for event in self._draw_result_events(await image_tasks.pop(0)):
+                        yield event
+        finally:
+            # 对话结束或者调用方停止迭代时,清理后台任务
+            for task in [request_task, heartbeat_task, receive_task, *image_tasks]:
+                if task is not None and not task.done():
+                    task.cancel()
+            if not request_task.cancelled() and request_task.done():
+                # 连接失败时没有人等待请求的构建结果,读取异常避免asyncio的警告
+                request_task.exception()
+            if frame_writer is not None:
+                await frame_writer.close()
+
+    def _chathub_url(self, chat_data: dict) -> str:
+        access_token = chat_data.get("access_token", "")
+        conversation_signature = chat_data.get("conversationSignature", "")
+        if access_token or (not conversation_signature):
+            return (
+                    (self.wss_link or "wss://sydney.bing.com/sydney/ChatHub")
+                    + "?sec_access_token="
+                    + access_token
+            )
+        return self.wss_link or "wss://sydney.bing.com/sydney/ChatHub"
+
+    async def _connect(self, chat_data: dict) -> aiohttp.ClientWebSocketResponse:
+        """连接ChatHub并完成协议握手"""
+        wss_headers = WSSHEADERS
+        if self.cookie_jar is not None:
+            wss_cookies = [f"{cookie.key}={cookie.value}" for cookie in self.cookie_jar]
+            wss_headers["cookie"] = ";".join(wss_cookies)
+        with self.breakers["chathub"].guard():
+            wss = await self.session.ws_connect(
+                url=self._chathub_url(chat_data),
+                ssl=ssl_context,
+                headers=wss_headers,
+                proxy=self.proxy,
+            )
+            try:
+                await wss.send_str(HANDSHAKE_MESSAGE)
+                await wss.receive_str()
+            except BaseException:
+                await wss.close()
+                raise
+        return wss
+
+    async def prepare(self, chat: dict = None, ttl: float = 15) -> dict:
+        """提前准备一轮对话:没有传入chat时创建新的对话,获取token,连接ChatHub并完成握手,
+        可以在用户还在输入时调用。返回的chat在ttl秒内传入ask_stream_raw时会直接使用准备好的连接,
+        超时后连接会被关闭"""
+        if not chat:
+            chat = await self.create_chat()
+        chat_data = await self.ensure_token(chat)
+        conversation_id = chat_data["conversationId"]
+        self._close_prepared(conversation_id)
+        wss = await self._connect(chat_data)
+        self._prepared[conversation_id] = (wss, monotonic() + ttl)
+        asyncio.get_running_loop().call_later(
+            ttl, self._close_prepared, conversation_id, wss
+        )
+        return chat
+
+    def _take_prepared(self, conversation_id: str) -> aiohttp.ClientWebSocketResponse | None:
+        wss, expires_at = self._prepared.pop(conversation_id, (None, 0))
+        if wss is None:
+            return None
+        if wss.closed or expires_at < monotonic():
+            asyncio.create_task(wss.close())
+            return None
+        return wss
+
+    def _close_prepared(
+            self, conversation_id: str, wss: aiohttp.ClientWebSocketResponse = None
+    ) -> None:
+        """关闭还没有使用的预先连接,传入wss时只在它还没有被使用时关闭"""
+        prepared, _ = self._prepared.get(conversation_id, (None, 0))
+        if prepared is not None and (wss is None or prepared is wss):
+            del self._prepared[conversation_id]
+            asyncio.create_task(prepared.close())
+
+    async def _heartbeat(self, wss: aiohttp.ClientWebSocketResponse):
+        """按固定的间隔向ChatHub发送心跳,直到连接关闭"""
+        while not wss.closed:
+            await asyncio.sleep(self.heartbeat_interval)
+            if wss.closed:
+                break
+            try:
+                await wss.send_str(PING_MESSAGE)
+            except ConnectionError:
+                break
+
+    @staticmethod
+    def _draw_result_events(result: List[Image] | Apology) -> List[Image | Apology]:
+        if isinstance(result, Apology):
+            return [result]
+        elif isinstance(result, list):
+            return result
+        else:
+            return [Apology(content="Unknown error when drawing.")]
+
+    @single_flight
+    @async_retry(5, breaker="history")
+    async def _list_chats(self) -> Tuple[str, dict]:
+        """获取最多200个bing的会话窗口的信息,返回(clientId, chats),不修改self.chats"""
+        async with self.session.get(
+                "https://www.bing.com/turing/conversation/chats",
+                headers=HEADERS,
+                proxy=self.proxy,
+        ) as response:
+            await check_response(response)
+            resp = await response.json()
+            return resp["clientId"], {
+                chat["conversationId"]: {**chat, **{"isStart": False}}
+                for chat in resp["chats"]
+            }
+
+    @single_flight
     async def get_chats(self):
         """获取最多200个bing的会话窗口的信息"""
-        async with aiohttp.ClientSession(cookie_jar=self.cookie_jar) as session:
-            async with session.get(
-                    "https://www.bing.com/turing/conversation/chats",
-                    headers=HEADERS,
-                    proxy=self.proxy,
-            ) as response:
-                resp = await response.json()
-                self.client_id = resp["clientId"]
-                self.chats = {
-                    chat["conversationId"]: {**chat, **{"isStart": False}}
-                    for chat in resp["chats"]
-                }
-                logger.info("Succeed to get chat lists")
-                return self.chats
-
-    @async_retry(10)
+        self.client_id, self.chats = await self._list_chats()
+        if self.store is not None:
+            self.store.replace_chats(self.client_id, self.chats)
+        logger.info("Succeed to get chat lists")
+        return self.chats
+
+    @single_flight
+    @async_retry(10, breaker="token")
     async def get_token(self, conversation_id):
         """获取对应聊天窗口的access_token"""
         timeout = aiohttp.ClientTimeout(total=20)
-        async with aiohttp.ClientSession(
-                cookie_jar=self.cookie_jar, timeout=timeout
-        ) as session:
-            async with session.get(
-                    f"https://www.bing.com/turing/conversation/create?conversationId={urllib.parse.quote(conversation_id, safe='')}",
-                    headers=HEADERS,
-                    proxy=self.proxy,
-            ) as response:
-                access_token = response.headers.get(
-                    "X-Sydney-EncryptedConversationSignature"
-                )
-                if access_token:
-                    self.chats[conversation_id]["access_token"] = urllib.parse.quote(
-                        access_token, safe=""
-                    )  # noqa: E501
-                else:
-                    return
+        async with self.session.get(
+                f"https://www.bing.com/turing/conversation/create?conversationId={urllib.parse.quote(conversation_id, safe='')}",
+                headers=HEADERS,
+                timeout=timeout,
+                proxy=self.proxy,
+        ) as response:
+            await check_response(response)
+            access_token = response.headers.get(
+                "X-Sydney-EncryptedConversationSignature"
+            )
+            chat_data = self.chats.setdefault(
+                conversation_id, {"conversationId": conversation_id}
+            )
+            chat_data["time"] = time()
+            if access_token:
+                chat_data["access_token"] = urllib.parse.quote(
+                    access_token, safe=""
+                )  # noqa: E501
+            self._save_chat(conversation_id)
 
-    @async_retry(10)
+    @single_flight
+    @async_retry(10, breaker="history")
     async def get_chat_history(self, conversation_id):
         """获取对应的聊天窗口的所有消息"""
         conversation_signature = self.chats[conversation_id].get(
@@ -589,17 +1088,16 @@ class Bing_Client:
         else:
             url = f"https://sydney.bing.com/sydney/GetConversation?conversationId={conversation_id}&source=cib&participantId={self.client_id}&traceId={uuid.uuid4()}"
         timeout = aiohttp.ClientTimeout(total=20)
-        async with aiohttp.ClientSession(
-                cookie_jar=self.cookie_jar, timeout=timeout
-        ) as session:
-            async with session.get(
-                    url,
-                    headers=HEADERS,
-                    proxy=self.proxy,
-            ) as response:
-                data = await response.json()
-                self.chats[conversation_id]["message"] = data.get("messages", [])
-                return
+        async with self.session.get(
+                url,
+                headers=HEADERS,
+                timeout=timeout,
+                proxy=self.proxy,
+        ) as response:
+            await check_response(response)
+            data = await response.json()
+            self.chats[conversation_id]["message"] = data.get("messages", [])
+            return
 
     async def load_chat_data(self, conversation_id, load_history: bool = False) -> None:
         """获取某个会话窗口的所有聊天信息(如果load_history)和access_token(如果有)"""
@@ -609,74 +1107,164 @@ class Bing_Client:
 
         await asyncio.gather(*tasks)
 
-    async def load_all_chats(self, load_history: bool = False):
-        """并发拉取所有的chat的信息,并入client的chats进行缓存"""
-        tasks = []
-        for conversation_id in list(self.chats.keys()):
-            task = asyncio.create_task(
-                self.load_chat_data(conversation_id, load_history=load_history)
-            )
-            tasks.append(task)
-        await asyncio.gather(*tasks)
+    async def load_all_chats(
+            self,
+            load_history: bool = False,
+            concurrency: int = 8,
+            progress: Callable[[int, int], Any] = None,
+    ):
+        """并发拉取所有的chat的信息,并入client的chats进行缓存,最多同时拉取concurrency个会话,
+        每完成一个会话会调用progress(已完成数量, 总数量)"""
+        conversation_ids = list(self.chats.keys())
+        pending = iter(conversation_ids)
+        finished = 0
+
+        async def worker():
+            nonlocal finished
+            for conversation_id in pending:
+                try:
+                    await self.load_chat_data(conversation_id, load_history=load_history)
+                except Exception as e:
+                    logger.error(f"Failed to load chat:{conversation_id} for the reason below:\n{e}")
+                finished += 1
+                if progress:
+                    progress(finished, len(conversation_ids))
+
+        await asyncio.gather(
+            *[worker() for _ in range(min(concurrency, len(conversation_ids)))]
+        )
         logger.info(
             f"Succeed to load all chat's data{'and history' if load_history else ''}"
         )
         return
 
-    @async_retry(3)
+    @single_flight
+    async def _reload_chats(self) -> None:
+        """重新拉取会话列表和所有会话的access_token,并发的调用只会执行一次"""
+        await self.get_chats()
+        await self.load_all_chats()
+
     async def delete_conversation(self, conversation_id) -> None:
         """删除指定的会话"""
         if conversation_id not in self.chats.keys():
-            await self.get_chats()
-            await self.load_all_chats()
+            await self._reload_chats()
         if conversation_id not in self.chats.keys():
             raise Exception("The conversation didn't exist")
-        else:
-            async with aiohttp.ClientSession(
-                    cookie_jar=self.cookie_jar, headers=DELETE_HEADERS
-            ) as session:
-                async with session.post(
-                        "https://sydney.bing.com/sydney/DeleteSingleConversation",
-                        data=json.dumps(
-                            {
-                                "conversationId": conversation_id,
-                                "conversationSignature": self.chats[conversation_id][
-                                    "conversationSignature"
-                                ],
-                                "participant": {"id": self.client_id},
-                                "source": "cib",
-                                "optionsSets": ["autosave"],
-                            }
-                        ),
-                        proxy=self.proxy,
-                ) as resp:
-                    if resp.status == 200:
-                        logger.info(f"Succeed to delete conservation:{conversation_id}")
-                        del self.chats[conversation_id]
-                        return
-                    else:
-                        text = await resp.text()
-                        raise Exception(f"Failed to delete conversation:{text}")
+        await self._admit("delete")
+        await self._delete_request(conversation_id)
+
+    @async_retry(3, breaker="delete")
+    async def _delete_request(self, conversation_id) -> None:
+        async with self.session.post(
+                "https://sydney.bing.com/sydney/DeleteSingleConversation",
+                headers=DELETE_HEADERS,
+                data=json.dumps(
+                    {
+                        "conversationId": conversation_id,
+                        "conversationSignature": self.chats[conversation_id][
+                            "conversationSignature"
+                        ],
+                        "participant": {"id": self.client_id},
+                        "source": "cib",
+                        "optionsSets": ["autosave"],
+                    }
+                ),
+                proxy=self.proxy,
+        ) as resp:
+            if resp.status == 200:
+                logger.info(f"Succeed to delete conservation:{conversation_id}")
+                self.chats.pop(conversation_id, None)
+                self.token_refresher.forget(conversation_id)
+                if self.store is not None:
+                    self.store.delete_chat(conversation_id)
+                return
+            else:
+                text = await resp.text()
+                raise BingHTTPError(
+                    resp.status,
+                    f"Failed to delete conversation:{text}",
+                    parse_retry_after(resp.headers.get("Retry-After")),
+                )
+
+    async def delete_conversations(
+            self,
+            conversation_ids: List[str],
+            concurrency: int = 4,
+            checkpoint: str | Path = None,
+    ) -> List[DeleteResult]:
+        """批量删除会话,最多同时删除concurrency个,按传入顺序返回每个会话的DeleteResult
+        有不认识的会话时只在开始时重新拉取一次会话列表,
+        设置checkpoint时每删除成功一个就记录到这个文件中,中断后用同一个文件重新调用会跳过已经删除的会话"""
+        done = set()
+        if checkpoint is not None:
+            checkpoint = Path(checkpoint)
+            if checkpoint.exists():
+                done = set(checkpoint.read_text(encoding="utf-8").split())
+        pending = [cid for cid in dict.fromkeys(conversation_ids) if cid not in done]
+        unknown = [cid for cid in pending if cid not in self.chats]
+        if unknown:
+            # 只补充不认识的会话,已有会话的token和本地新建但还没出现在列表中的会话保持不变
+            self.client_id, listed = await self._list_chats()
+            for cid in unknown:
+                if cid in listed:
+                    self.chats[cid] = listed[cid]
+                    self._save_chat(cid)
+        results: Dict[str, DeleteResult] = {
+            cid: DeleteResult(conversation_id=cid, success=True)
+            for cid in conversation_ids
+            if cid in done
+        }
+        checkpoint_file = (
+            open(checkpoint, "a", encoding="utf-8") if checkpoint is not None else None
+        )
+        iterator = iter(pending)
+
+        async def worker():
+            for conversation_id in iterator:
+                if conversation_id not in self.chats:
+                    results[conversation_id] = DeleteResult(
+                        conversation_id=conversation_id,
+                        success=False,
+                        error="The conversation didn't exist",
+                    )
+                    continue
+                try:
+                    await self._admit("delete")
+                    await self._delete_request(conversation_id)
+                except Exception as e:
+                    results[conversation_id] = DeleteResult(
+                        conversation_id=conversation_id, success=False, error=str(e)
+                    )
+                    continue
+                results[conversation_id] = DeleteResult(
+                    conversation_id=conversation_id, success=True
+                )
+                if checkpoint_file is not None:
+                    checkpoint_file.write(conversation_id + "\n")
+                    checkpoint_file.flush()
+
+        try:
+            await asyncio.gather(
+                *[worker() for _ in range(min(concurrency, len(pending)))]
+            )
+        finally:
+            if checkpoint_file is not None:
+                checkpoint_file.close()
+        return [results[cid] for cid in conversation_ids]
 
     async def delete_conversation_by_count(
-            self, count: int = 20, del_all: bool = False
-    ):
+            self, count: int = 20, del_all: bool = False, concurrency: int = 4
+    ) -> List[DeleteResult]:
         """按照数量删除你的对话窗口,也可以设置全部删除"""
-        chats = list(self.chats.values())
+        conversation_ids = list(self.chats.keys())
         if not del_all:
-            if count > len(chats):
-                logger.error(f"Only {len(chats)} conversation fount")
-            chats = chats[:count]
-
-        async def del_conversation_no_exception(conversation_id):
-            try:
-                await self.delete_conversation(conversation_id)
-            except Exception as e:
+            if count > len(conversation_ids):
+                logger.error(f"Only {len(conversation_ids)} conversation fount")
+            conversation_ids = conversation_ids[:count]
+        results = await self.delete_conversations(conversation_ids, concurrency)
+        for result in results:
+            if not result.success:
                 logger.error(
-                    f"Failed to delete conversation:{conversation_id} for the reason below:\n{e}"
+                    f"Failed to delete conversation:{result.conversation_id} for the reason below:\n{result.error}"
                 )
-
-        tasks = []
-        for chat in chats:
-            tasks.append(del_conversation_no_exception(chat["conversationId"]))
-        await asyncio.gather(*tasks)
+        return results
@@ -6,6 +6,15 @@ from pydantic.types import Enum
 FORWARDED_IP = (
     f"13.{random.randint(104, 107)}.{random.randint(0, 255)}.{random.randint(0, 255)}"
 )
+# access_token的有效期(秒),超过后需要重新获取
+TOKEN_TTL = 2500
+# 查询画图结果的间隔(秒),从DRAW_POLL_INTERVAL开始每次乘以1.5,最多DRAW_POLL_MAX_INTERVAL
+DRAW_POLL_INTERVAL = 1
+DRAW_POLL_MAX_INTERVAL = 5
+# 固定不变的ChatHub帧,提前编码好
+HANDSHAKE_MESSAGE = '{"protocol": "json", "version": 1}\x1e'
+PING_MESSAGE = '{"type": 6}\x1e'
+CLOSE_MESSAGE = '{"type": 7}\x1e'
 HEADERS = {
     "Referer": "https://www.bing.com/search?q=Bing",
     "Sec-Ch-Ua": '"Not/A)Brand";v="99", "Google Chrome";v="115", "Chromium";v="115"',
@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import asyncio
+from collections import deque
+from time import time
+from typing import Deque, Optional, TYPE_CHECKING
+
+from loguru import logger
+
+from .const import TOKEN_TTL
+
+if TYPE_CHECKING:
+    from .client import Bing_Client
+
+
+class ConversationPool:
+    """预先创建好的对话(带access_token),在后台保持size个,新的对话直接从这里取出,
+    剩余有效期不足min_ttl秒的对话会被丢弃"""
+
+    def __init__(
+            self,
+            client: Bing_Client,
+            size: int,
+            min_ttl: float = 600,
+            priority: int = 10,
+    ):
+        self.client = client
+        self.size = size
+        self.min_ttl = min_ttl
+        # 后台补充时在create的准入队列中的优先级,低于用户的请求
+        self.priority = priority
+        self._chats: Deque[dict] = deque()
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._running = False
+
+    def __len__(self):
+        self._evict()
+        return len(self._chats)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._running = True
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._fill())
+
+    def take(self) -> dict | None:
+        """取出一个可用的对话,没有时返回None"""
+        self._evict()
+        chat = self._chats.popleft() if self._chats else None
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return chat
+
+    async def close(self) -> None:
+        self._running = False
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _expired(self, chat: dict) -> bool:
+        chat_data = list(chat.values())[0]
+        return time() - chat_data.get("time", 0) > TOKEN_TTL - self.min_ttl
+
+    def _evict(self) -> None:
+        # 对话按创建顺序排列,最旧的在最左边
+        while self._chats and self._expired(self._chats[0]):
+            self._chats.popleft()
+            if self._wakeup is not None:
+                self._wakeup.set()
+
+    async def _fill(self) -> None:
+        failures = 0
+        while self._running:
+            self._evict()
+            if len(self._chats) < self.size:
+                try:
+                    await self.client._admit("create", self.priority)
+                    self._chats.append(await self.client._request_new_chat())
+                    failures = 0
+                except Exception as e:
+                    failures += 1
+                    logger.error(f"Failed to pre-create chat: {e}")
+                    await asyncio.sleep(min(2 ** failures, 60))
+                continue
+            self._wakeup.clear()
+            # 最旧的对话快要过期时也需要醒来补充
+            next_expiry = (
+                list(self._chats[0].values())[0].get("time", 0)
+                + TOKEN_TTL
+                - self.min_ttl
+                - time()
+            )
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(next_expiry, 1))
+            except asyncio.TimeoutError:
+                pass
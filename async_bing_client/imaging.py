@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+import asyncio
+import base64
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+from typing import Optional
+
+from PIL import Image, ImageOps
+
+# 压缩后图片的目标大小,同时也是JPEG原样上传的上限
+MAX_IMAGE_SIZE = 1_000_000
+
+
+def compress_image_sync(infile: bytes, max_size: int = MAX_IMAGE_SIZE) -> str:
+    """把图片压缩成不超过大约max_size字节的JPEG并返回base64,
+    已经是RGB或灰度JPEG且不超过max_size的图片原样返回,
+    大图先用JPEG的draft模式(解码时按1/2,1/4,1/8缩小)或reduce快速缩小,再缩放到目标尺寸
+    这是一个模块级的函数,可以在进程池中执行"""
+    img = Image.open(BytesIO(infile))
+    size = len(infile)
+    if size <= max_size and img.format == "JPEG" and img.mode in ("RGB", "L"):
+        return base64.b64encode(infile).decode("utf-8")
+    if size > max_size:
+        ratio = (size / max_size) ** 0.6
+        new_width = int(img.width / ratio)
+        new_height = int(img.height / ratio)
+        if img.format == "JPEG":
+            img.draft("RGB", (new_width, new_height))
+        img = img.convert("RGB")
+        factor = min(img.width // new_width, img.height // new_height)
+        if factor >= 2:
+            img = img.reduce(factor)
+        img = ImageOps.fit(img, (new_width, new_height), method=Image.LANCZOS)
+    else:
+        img = img.convert("RGB")
+    outfile = BytesIO()
+    img.save(outfile, format="JPEG", quality=80, optimize=True)
+    return base64.b64encode(outfile.getvalue()).decode("utf-8")
+
+
+class ImageTooLarge(ValueError):
+    """图片超过了ImageExecutor的max_input_bytes"""
+
+
+class ImageExecutor:
+    """专门用于压缩图片的执行器,不占用事件循环默认的线程池
+    use_processes为True时使用进程池(不受GIL限制),最多max_pending个图片同时排队或处理,
+    超过的调用会等待,超过max_input_bytes的图片直接拒绝"""
+
+    def __init__(
+            self,
+            max_workers: int = 2,
+            use_processes: bool = False,
+            max_pending: int = 16,
+            max_input_bytes: int = 50 * 1024 * 1024,
+    ):
+        self.max_workers = max_workers
+        self.use_processes = use_processes
+        self.max_pending = max_pending
+        self.max_input_bytes = max_input_bytes
+        self._executor: Optional[Executor] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    @property
+    def executor(self) -> Executor:
+        """第一次使用时创建,close之后再使用会重新创建"""
+        if self._executor is None:
+            if self.use_processes:
+                self._executor = ProcessPoolExecutor(self.max_workers)
+            else:
+                self._executor = ThreadPoolExecutor(
+                    self.max_workers, thread_name_prefix="bing-image"
+                )
+        return self._executor
+
+    async def compress(self, data: bytes) -> str:
+        if len(data) > self.max_input_bytes:
+            raise ImageTooLarge(
+                f"Image is {len(data)} bytes, more than the limit of {self.max_input_bytes} bytes"
+            )
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_pending)
+        async with self._semaphore:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, compress_image_sync, data
+            )
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+from time import monotonic
+from typing import List, NamedTuple, Optional, Tuple
+
+
+class RateLimit(NamedTuple):
+    """每period秒最多count次,同时也是令牌桶的容量(允许的突发量)"""
+
+    count: int
+    period: float
+
+    @classmethod
+    def per_minute(cls, count: int) -> RateLimit:
+        return cls(count, 60)
+
+    @classmethod
+    def per_hour(cls, count: int) -> RateLimit:
+        return cls(count, 3600)
+
+
+class AdmissionTimeout(Exception):
+    """请求在准入队列中等待超过了max_wait"""
+
+
+class TokenBucket:
+    def __init__(self, limit: RateLimit):
+        self.rate = limit.count / limit.period
+        self.capacity = float(limit.count)
+        self.tokens = self.capacity
+        self.updated_at = monotonic()
+
+    def _refill(self) -> None:
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_take(self) -> float:
+        """有令牌时取走一个并返回0,否则返回还需要等待的秒数"""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """单个接口的令牌桶和准入队列,超出限制的请求按优先级(数字越小越优先)和到达顺序排队等待,
+    而不是直接失败,等待超过max_wait时抛出AdmissionTimeout"""
+
+    def __init__(self, name: str, limit: RateLimit):
+        self.name = name
+        self.limit = limit
+        self.bucket = TokenBucket(limit)
+        self._queue: List[Tuple[int, int, asyncio.Future]] = []
+        self._counter = itertools.count()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self.admitted = 0
+        self.timed_out = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(1 for _, _, waiter in self._queue if not waiter.done())
+
+    async def acquire(self, priority: int = 0, max_wait: float = None) -> None:
+        started_at = monotonic()
+        if not self.queue_depth and self.bucket.try_take() == 0:
+            self._record_wait(0.0)
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._counter), waiter))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        try:
+            await asyncio.wait_for(waiter, max_wait)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            raise AdmissionTimeout(
+                f"Waited more than {max_wait}s for the '{self.name}' rate limit"
+            ) from None
+        self._record_wait(monotonic() - started_at)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth,
+            "admitted": self.admitted,
+            "timed_out": self.timed_out,
+            "average_wait": self.total_wait / self.admitted if self.admitted else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+    def _record_wait(self, waited: float) -> None:
+        self.admitted += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+
+    async def _dispatch(self) -> None:
+        while self._queue:
+            # 跳过已经超时或被取消的请求
+            if self._queue[0][2].done():
+                heapq.heappop(self._queue)
+                continue
+            wait = self.bucket.try_take()
+            if wait:
+                await asyncio.sleep(wait)
+                continue
+            heapq.heappop(self._queue)[2].set_result(None)
@@ -0,0 +1,201 @@
+from __future__ import annotations
+
+import asyncio
+from pathlib import Path
+from time import monotonic
+from typing import List, Dict, AsyncGenerator, Any
+
+from loguru import logger
+
+from .breaker import OPEN, CircuitOpenError
+from .client import Bing_Client
+from .type import NewChat, Limit, LimitEvent, Image, Apology
+from .utils import is_retryable
+
+
+class AccountStats:
+    """单个账号的实时状态,用来计算它还剩多少余量"""
+
+    # 错误率和额度使用率的平滑系数
+    alpha = 0.2
+
+    def __init__(self):
+        self.inflight = 0
+        self.error_rate = 0.0
+        self.limit_usage = 0.0
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self.cooldown = 0.0
+
+    def record_limit(self, num_user_messages: int, max_num_user_messages: int) -> None:
+        if max_num_user_messages:
+            usage = min(num_user_messages / max_num_user_messages, 1.0)
+            self.limit_usage += self.alpha * (usage - self.limit_usage)
+
+    def record_success(self) -> None:
+        self.error_rate -= self.alpha * self.error_rate
+        self.consecutive_failures = 0
+        self.cooldown = 0.0
+
+    def record_failure(self) -> None:
+        self.error_rate += self.alpha * (1 - self.error_rate)
+        self.consecutive_failures += 1
+
+    @property
+    def headroom(self) -> float:
+        return (1 - self.error_rate) * (1 - self.limit_usage) / (1 + self.inflight)
+
+
+class BingClientPool:
+    """管理多个账号的Bing_Client,新的对话会分配给余量最多的账号,已有的对话始终留在它所属的账号上,
+    被限流或持续失败的账号会暂时移出轮换,冷却后再重新加入"""
+
+    def __init__(
+            self,
+            clients: List[Bing_Client],
+            max_consecutive_failures: int = 3,
+            max_error_rate: float = 0.5,
+            cooldown: float = 60,
+            max_cooldown: float = 1800,
+    ):
+        if not clients:
+            raise ValueError("BingClientPool needs at least one client")
+        self.clients = clients
+        self.max_consecutive_failures = max_consecutive_failures
+        self.max_error_rate = max_error_rate
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.stats: Dict[int, AccountStats] = {id(client): AccountStats() for client in clients}
+        self.owners: Dict[str, Bing_Client] = {}
+
+    @classmethod
+    def from_cookies(cls, cookies: List[str | Path | List[dict]], proxy=None, **kwargs):
+        """用多个cookie创建账号池,其余参数会传给每个Bing_Client"""
+        return cls([Bing_Client(cookie, proxy=proxy, **kwargs) for cookie in cookies])
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.aclose()
+
+    async def init(self, **kwargs):
+        """初始化所有账号,参数会传给每个Bing_Client.init,初始化失败的账号会先移出轮换"""
+        results = await asyncio.gather(
+            *[client.init(**kwargs) for client in self.clients], return_exceptions=True
+        )
+        for client, result in zip(self.clients, results):
+            if isinstance(result, Exception):
+                logger.error(f"Failed to init bing account: {result}")
+                self._record_failure(client, exhausted=True)
+        return self
+
+    async def aclose(self):
+        await asyncio.gather(*[client.aclose() for client in self.clients])
+
+    def available(self, client: Bing_Client) -> bool:
+        """账号是否在轮换中:不在冷却期,并且创建对话和ChatHub的断路器都没有打开"""
+        if self.stats[id(client)].cooldown_until > monotonic():
+            return False
+        return all(
+            client.breakers[name].state != OPEN for name in ("create", "chathub")
+        )
+
+    def pick(self) -> Bing_Client:
+        """选出余量最多的可用账号"""
+        candidates = [client for client in self.clients if self.available(client)]
+        if not candidates:
+            raise Exception("No bing account is available now, all of them are throttled or failing")
+        return max(candidates, key=lambda client: self.stats[id(client)].headroom)
+
+    def owner(self, chat: dict | str) -> Bing_Client:
+        """找到对话所属的账号"""
+        conversation_id = chat if isinstance(chat, str) else list(chat.keys())[0]
+        client = self.owners.get(conversation_id)
+        if client is None:
+            for candidate in self.clients:
+                if conversation_id in candidate.chats:
+                    client = self.owners[conversation_id] = candidate
+                    break
+            else:
+                raise ValueError(f"The conversation {conversation_id} doesn't belong to any account")
+        return client
+
+    async def create_chat(self):
+        client = self.pick()
+        chat = await self._call(client, client.create_chat())
+        self.owners[list(chat.keys())[0]] = client
+        return chat
+
+    async def draw(self, prompt: str, *args, **kwargs) -> List[Image] | Apology:
+        client = self.pick()
+        return await self._call(client, client.draw(prompt, *args, **kwargs))
+
+    async def ask_stream_raw(
+            self,
+            question: str,
+            image: str | Path | bytes = None,
+            chat: dict = None,
+            *args,
+            **kwargs,
+    ) -> AsyncGenerator[Any, None]:
+        """和Bing_Client.ask_stream_raw相同,没有传入chat时由余量最多的账号创建新的对话"""
+        client = self.owner(chat) if chat else self.pick()
+        stats = self.stats[id(client)]
+        stats.inflight += 1
+        try:
+            async for event in client.ask_stream_raw(question, image, chat, *args, **kwargs):
+                if isinstance(event, NewChat):
+                    self.owners[list(event.chat.keys())[0]] = client
+                elif isinstance(event, (Limit, LimitEvent)):
+                    stats.record_limit(event.num_user_messages, event.max_num_user_messages)
+                yield event
+        except Exception as e:
+            self._record_error(client, e)
+            raise
+        else:
+            stats.record_success()
+        finally:
+            stats.inflight -= 1
+
+    # ask_stream只依赖ask_stream_raw,直接复用Bing_Client的实现
+    ask_stream = Bing_Client.ask_stream
+
+    async def _call(self, client: Bing_Client, coro):
+        stats = self.stats[id(client)]
+        stats.inflight += 1
+        try:
+            result = await coro
+        except Exception as e:
+            self._record_error(client, e)
+            raise
+        else:
+            stats.record_success()
+            return result
+        finally:
+            stats.inflight -= 1
+
+    def _record_error(self, client: Bing_Client, error: BaseException) -> None:
+        """账号被限流(429)或者断路器打开时立即移出轮换,其它网络和服务端错误累计到一定程度后移出"""
+        status = getattr(error, "status", None)
+        if isinstance(error, CircuitOpenError) or status == 429:
+            self._record_failure(client, exhausted=True)
+        elif status in (401, 403) or is_retryable(error):
+            self._record_failure(client)
+
+    def _record_failure(self, client: Bing_Client, exhausted: bool = False) -> None:
+        stats = self.stats[id(client)]
+        stats.record_failure()
+        if (
+                exhausted
+                or stats.consecutive_failures >= self.max_consecutive_failures
+                or stats.error_rate >= self.max_error_rate
+        ):
+            stats.cooldown = min(
+                stats.cooldown * 2 if stats.cooldown else self.base_cooldown,
+                self.max_cooldown,
+            )
+            stats.cooldown_until = monotonic() + stats.cooldown
+            logger.warning(
+                f"Bing account {self.clients.index(client)} is taken out of rotation for {stats.cooldown:.0f}s"
+            )
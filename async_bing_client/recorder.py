@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+import asyncio
+import os
+from pathlib import Path
+from time import time
+from typing import List, Optional
+
+from regex import regex
+
+
+class FrameRecorder:
+    """可选的ChatHub原始帧记录器,每个会话的每次调用写入一个JSON Lines文件,
+    写入在线程池中进行,不会阻塞事件循环"""
+
+    def __init__(
+            self,
+            directory: str | Path = "frames",
+            max_bytes: int = 10 * 1024 * 1024,
+            backup_count: int = 3,
+    ):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+
+    def open(self, conversation_id: str, invocation_id: str | int = None) -> FrameWriter:
+        """为一次调用创建一个写入器,文件名为 会话id-调用id.jsonl"""
+        if invocation_id is None:
+            invocation_id = int(time() * 1000)
+        name = regex.sub(r"[^\w.-]", "_", f"{conversation_id}-{invocation_id}")
+        return FrameWriter(self.directory / f"{name}.jsonl", self.max_bytes, self.backup_count)
+
+
+class FrameWriter:
+    def __init__(self, path: Path, max_bytes: int, backup_count: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._buffer: List[str] = []
+        self._task: Optional[asyncio.Task] = None
+        self._size: Optional[int] = None
+
+    def write(self, frame: str) -> None:
+        """记录一个原始帧(已经是json字符串),实际的写入会在后台批量进行"""
+        if "\n" in frame or "\r" in frame:
+            # json中字符串内的换行都是转义过的,这里的换行只是空白,可以直接去掉
+            frame = frame.replace("\r", "").replace("\n", "")
+        self._buffer.append(frame + "\n")
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._flush())
+
+    async def close(self) -> None:
+        """等待所有缓存的帧写入完毕"""
+        if self._task is not None:
+            await self._task
+        if self._buffer:
+            await self._flush()
+
+    async def _flush(self) -> None:
+        loop = asyncio.get_running_loop()
+        while self._buffer:
+            lines, self._buffer = self._buffer, []
+            await loop.run_in_executor(None, self._write_lines, lines)
+
+    def _write_lines(self, lines: List[str]) -> None:
+        if self._size is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._size = self.path.stat().st_size if self.path.exists() else 0
+        f = open(self.path, "ab")
+        try:
+            for line in lines:
+                data = line.encode("utf-8")
+                if self.max_bytes and self._size and self._size + len(data) > self.max_bytes:
+                    f.close()
+                    self._rotate()
+                    f = open(self.path, "ab")
+                f.write(data)
+                self._size += len(data)
+        finally:
+            f.close()
+
+    def _rotate(self) -> None:
+        if self.backup_count > 0:
+            for index in range(self.backup_count - 1, 0, -1):
+                source = self.path.with_name(f"{self.path.name}.{index}")
+                if source.exists():
+                    os.replace(source, self.path.with_name(f"{self.path.name}.{index + 1}"))
+            os.replace(self.path, self.path.with_name(f"{self.path.name}.1"))
+        else:
+            self.path.unlink()
+        self._size = 0
@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import asyncio
+import random
+from time import time
+from typing import Dict, Optional, Tuple, TYPE_CHECKING
+
+from loguru import logger
+
+from .const import TOKEN_TTL
+
+if TYPE_CHECKING:
+    from .client import Bing_Client
+
+
+class TokenRefresher:
+    """在后台提前刷新活跃会话的access_token,让对话时基本不需要等待获取token
+    每个会话在过期前lead秒再随机提前0~jitter秒刷新,避免大量会话同时刷新,
+    超过idle_timeout秒没有使用的会话不再刷新"""
+
+    def __init__(
+            self,
+            client: Bing_Client,
+            lead: float = 300,
+            jitter: float = 120,
+            idle_timeout: float = 3600,
+    ):
+        self.client = client
+        self.lead = lead
+        self.jitter = jitter
+        self.idle_timeout = idle_timeout
+        # 会话id -> 最后一次使用的时间
+        self._active: Dict[str, float] = {}
+        # 会话id -> (计算时的token时间, 计划刷新的时间)
+        self._schedule: Dict[str, Tuple[float, float]] = {}
+        # 后台发起的刷新,和对话时发起的刷新通过client.get_token的single_flight合并
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._running = False
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._running = True
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    def track(self, conversation_id: str) -> None:
+        """标记会话正在使用,之后由后台负责刷新它的token"""
+        if conversation_id not in self._active and self._wakeup is not None:
+            self._wakeup.set()
+        self._active[conversation_id] = time()
+
+    def forget(self, conversation_id: str) -> None:
+        self._active.pop(conversation_id, None)
+        self._schedule.pop(conversation_id, None)
+
+    def refresh(self, conversation_id: str) -> asyncio.Task:
+        """在后台刷新会话的token,已经在刷新时直接返回正在进行的任务"""
+        task = self._inflight.get(conversation_id)
+        if task is None:
+            task = self._inflight[conversation_id] = asyncio.create_task(
+                self.client.get_token(conversation_id)
+            )
+            task.add_done_callback(lambda _: self._on_done(conversation_id))
+        return task
+
+    async def close(self) -> None:
+        self._running = False
+        tasks = [task for task in [self._task, *self._inflight.values()] if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+        self._inflight.clear()
+
+    def _due(self, conversation_id: str) -> float | None:
+        chat_data = self.client.chats.get(conversation_id)
+        if chat_data is None:
+            return None
+        token_time = chat_data.get("time", 0)
+        scheduled = self._schedule.get(conversation_id)
+        if scheduled is None or scheduled[0] != token_time:
+            scheduled = self._schedule[conversation_id] = (
+                token_time,
+                token_time + TOKEN_TTL - self.lead - random.uniform(0, self.jitter),
+            )
+        return scheduled[1]
+
+    def _on_done(self, conversation_id: str) -> None:
+        self._inflight.pop(conversation_id, None)
+        # token时间变化后重新计算下一次刷新的时间
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _on_refreshed(self, conversation_id: str, task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception():
+            logger.error(
+                f"Failed to refresh token of chat:{conversation_id}: {task.exception()}"
+            )
+            # 失败后过一段时间再试,不要在下一轮立即重试
+            self._schedule[conversation_id] = (
+                self.client.chats.get(conversation_id, {}).get("time", 0),
+                time() + self.lead / 4,
+            )
+
+    async def _run(self) -> None:
+        # wait_for在超时和取消同时发生时可能吞掉取消,所以用_running来退出循环
+        while self._running:
+            now = time()
+            next_due = now + self.idle_timeout
+            for conversation_id, used_at in list(self._active.items()):
+                due = self._due(conversation_id)
+                if due is None or now - used_at > self.idle_timeout:
+                    self.forget(conversation_id)
+                    continue
+                if due <= now:
+                    if conversation_id not in self._inflight:
+                        self.refresh(conversation_id).add_done_callback(
+                            lambda task, cid=conversation_id: self._on_refreshed(cid, task)
+                        )
+                    continue
+                next_due = min(next_due, due)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(next_due - now, 1))
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,194 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from time import time
+from typing import Any, AsyncGenerator, List, Tuple
+
+from .cache import LRUCache
+from .type import (
+    Text,
+    SuggestRely,
+    SourceAttribution,
+    SearchResult,
+    Image,
+    TextEvent,
+    SuggestRelyEvent,
+    SourceAttributionEvent,
+    ImageEvent,
+    _Event,
+)
+from .utils import codec
+
+# 会被缓存和重放的事件
+CACHED_EVENTS = (
+    Text,
+    TextEvent,
+    SuggestRely,
+    SuggestRelyEvent,
+    SourceAttribution,
+    SourceAttributionEvent,
+    SearchResult,
+)
+
+
+def dump_events(events: List[Any]) -> str:
+    records = []
+    for event in events:
+        if isinstance(event, SearchResult):
+            records.append(["SearchResult", {"raw": event.raw}])
+            continue
+        model = event.to_model() if isinstance(event, _Event) else event
+        data = model.dict()
+        del data["type"]
+        if isinstance(model, SourceAttribution) and data["image"] is not None:
+            del data["image"]["type"]
+        records.append([model.type, data])
+    return codec.dumps(records)
+
+
+class ResponseCache:
+    """首轮且没有图片的对话的回复缓存,key由(question, style, locale, personality)计算,
+    保存回复中的Text,SourceAttribution,SuggestRely和SearchResult,命中时按原来的顺序重放,
+    pacing大于0时每个Text之间等待pacing秒以模拟流式输出,子类实现_get和_set"""
+
+    def __init__(self, ttl: float = 3600, pacing: float = 0):
+        self.ttl = ttl
+        self.pacing = pacing
+
+    @staticmethod
+    def key(question: str, conversation_style: Any, locale: str, personality: Any) -> str:
+        style = getattr(conversation_style, "name", conversation_style)
+        return hashlib.sha256(
+            codec.dumps([question, str(style).lower(), locale, personality]).encode()
+        ).hexdigest()
+
+    async def get(self, key: str) -> str | None:
+        return await self._get(key)
+
+    async def set(self, key: str, events: List[Any]) -> None:
+        await self._set(key, dump_events(events))
+
+    async def replay(self, data: str, fast_events: bool = False) -> AsyncGenerator[Any, None]:
+        if fast_events:
+            types = {
+                "Text": TextEvent,
+                "SuggestRely": SuggestRelyEvent,
+                "SourceAttribution": SourceAttributionEvent,
+            }
+        else:
+            types = {
+                "Text": Text,
+                "SuggestRely": SuggestRely,
+                "SourceAttribution": SourceAttribution,
+            }
+        for type_name, fields in codec.loads(data):
+            if type_name == "SearchResult":
+                yield SearchResult(raw=fields["raw"])
+                continue
+            if type_name == "Text" and self.pacing:
+                await asyncio.sleep(self.pacing)
+            if type_name == "SourceAttribution" and fields["image"] is not None:
+                fields["image"] = (ImageEvent if fast_events else Image)(**fields["image"])
+            yield types[type_name](**fields)
+
+    async def close(self) -> None:
+        pass
+
+    async def _get(self, key: str) -> str | None:
+        raise NotImplementedError
+
+    async def _set(self, key: str, data: str) -> None:
+        raise NotImplementedError
+
+
+class MemoryResponseCache(ResponseCache):
+    """保存在内存中,最多max_entries条,按最近使用淘汰"""
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600, pacing: float = 0):
+        super().__init__(ttl, pacing)
+        self.responses = LRUCache(max_entries, ttl)
+
+    async def _get(self, key: str) -> str | None:
+        return self.responses.get(key)
+
+    async def _set(self, key: str, data: str) -> None:
+        self.responses.set(key, data)
+
+
+class SQLiteResponseCache(ResponseCache):
+    """保存在sqlite中(多个进程可以共享),最多max_entries条,按最近使用淘汰,
+    所有的读写都在一个单独的线程中执行"""
+
+    def __init__(
+            self,
+            path: str | Path = "bing_responses.db",
+            max_entries: int = 10000,
+            ttl: float = 3600,
+            pacing: float = 0,
+    ):
+        super().__init__(ttl, pacing)
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="response-cache")
+        self._conn: sqlite3.Connection | None = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL, used_at REAL NOT NULL)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    async def close(self) -> None:
+        await self._submit(self._close)
+        self._executor.shutdown(wait=False)
+
+    def _submit(self, func, *args) -> asyncio.Future:
+        return asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def _get(self, key: str) -> str | None:
+        return await self._submit(self._select, key)
+
+    async def _set(self, key: str, data: str) -> None:
+        await self._submit(self._upsert, key, data)
+
+    def _select(self, key: str) -> str | None:
+        now = time()
+        row: Tuple[str] | None = self.conn.execute(
+            "SELECT data FROM responses WHERE key = ? AND expires_at > ?", (key, now)
+        ).fetchone()
+        if row is None:
+            return None
+        with self.conn:
+            self.conn.execute("UPDATE responses SET used_at = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def _upsert(self, key: str, data: str) -> None:
+        now = time()
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO responses (key, data, expires_at, used_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET data = excluded.data, "
+                "expires_at = excluded.expires_at, used_at = excluded.used_at",
+                (key, data, now + self.ttl, now),
+            )
+            self.conn.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+            self.conn.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def _close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
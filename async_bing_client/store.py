@@ -0,0 +1,219 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from loguru import logger
+
+from .utils import codec
+
+
+def dump_chat(chat_data: dict) -> str:
+    """序列化需要持久化的会话信息,聊天记录不保存,只记录会话已经开始过"""
+    data = {key: value for key, value in chat_data.items() if key != "message"}
+    if "message" in chat_data:
+        data["isStart"] = False
+    return codec.dumps(data)
+
+
+def _log_error(future: asyncio.Future) -> None:
+    if not future.cancelled() and future.exception():
+        logger.error(f"Failed to write chat store: {future.exception()}")
+
+
+class ChatStore:
+    """Bing_Client.chats,client_id和token时间的持久化后端,所有的读写都在一个单独的线程中按顺序执行,
+    每次只写入变化的会话,子类实现_load,_write,_set_client_id,_close"""
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chat-store")
+        # 最近一次写入的内容,没有变化的会话不会重复写入,只在写入线程中访问
+        self._written: Dict[str, str] = {}
+        self._client_id = ""
+        self._loaded = False
+
+    async def load(self) -> Tuple[str, dict]:
+        """返回保存的client_id和chats"""
+        client_id, rows = await self._submit(self._load_rows)
+        return client_id, {key: codec.loads(value) for key, value in rows.items()}
+
+    def put_chat(self, conversation_id: str, chat_data: dict) -> asyncio.Future:
+        return self._submit(self._put_rows, [(conversation_id, dump_chat(chat_data))], [])
+
+    def delete_chat(self, conversation_id: str) -> asyncio.Future:
+        return self._submit(self._put_rows, [], [conversation_id])
+
+    def replace_chats(self, client_id: str, chats: dict) -> asyncio.Future:
+        """用最新的会话列表替换保存的会话,只写入有变化的会话并删除已经不存在的会话"""
+        rows = [(key, dump_chat(value)) for key, value in chats.items()]
+        return self._submit(self._replace_rows, client_id, rows)
+
+    async def close(self) -> None:
+        await self._submit(self._close)
+        self._executor.shutdown(wait=False)
+
+    def _submit(self, func, *args) -> asyncio.Future:
+        future = asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        future.add_done_callback(_log_error)
+        return future
+
+    def _load_rows(self) -> Tuple[str, Dict[str, str]]:
+        self._client_id, rows = self._load()
+        self._written = dict(rows)
+        self._loaded = True
+        return self._client_id, rows
+
+    def _ensure_loaded(self) -> None:
+        # 没有调用过load时(比如init(refresh=True))先读出已经保存的内容,否则无法删除已经不存在的会话
+        if not self._loaded:
+            self._load_rows()
+
+    def _replace_rows(self, client_id: str, rows: List[Tuple[str, str]]) -> None:
+        self._ensure_loaded()
+        if client_id != self._client_id:
+            self._set_client_id(client_id)
+            self._client_id = client_id
+        keys = {key for key, _ in rows}
+        self._put_rows(rows, [key for key in self._written if key not in keys])
+
+    def _put_rows(self, rows: List[Tuple[str, str]], removed: List[str]) -> None:
+        self._ensure_loaded()
+        rows = [(key, value) for key, value in rows if self._written.get(key) != value]
+        removed = [key for key in removed if key in self._written]
+        if not rows and not removed:
+            return
+        self._write(rows, removed)
+        for key, value in rows:
+            self._written[key] = value
+        for key in removed:
+            del self._written[key]
+
+    def _load(self) -> Tuple[str, Dict[str, str]]:
+        raise NotImplementedError
+
+    def _write(self, rows: List[Tuple[str, str]], removed: List[str]) -> None:
+        raise NotImplementedError
+
+    def _set_client_id(self, client_id: str) -> None:
+        raise NotImplementedError
+
+    def _close(self) -> None:
+        pass
+
+
+class SQLiteChatStore(ChatStore):
+    """把每个会话保存为sqlite中的一行"""
+
+    def __init__(self, path: str | Path = "bing_chats.db"):
+        super().__init__()
+        self.path = Path(path)
+        self._conn: sqlite3.Connection | None = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS chats (id TEXT PRIMARY KEY, data TEXT NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def _load(self) -> Tuple[str, Dict[str, str]]:
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'client_id'").fetchone()
+        rows = dict(self.conn.execute("SELECT id, data FROM chats").fetchall())
+        return (row[0] if row else ""), rows
+
+    def _write(self, rows: List[Tuple[str, str]], removed: List[str]) -> None:
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO chats (id, data) VALUES (?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET data = excluded.data",
+                rows,
+            )
+            self.conn.executemany("DELETE FROM chats WHERE id = ?", [(key,) for key in removed])
+
+    def _set_client_id(self, client_id: str) -> None:
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('client_id', ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (client_id,),
+            )
+
+    def _close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class JSONChatStore(ChatStore):
+    """以JSON Lines追加日志的形式保存,每次变化追加一行,加载时日志过长会压缩重写一次"""
+
+    def __init__(self, path: str | Path = "bing_chats.jsonl"):
+        super().__init__()
+        self.path = Path(path)
+        self._lines = 0
+        self._needs_newline = False
+
+    def _load(self) -> Tuple[str, Dict[str, str]]:
+        client_id, rows = "", {}
+        self._lines = 0
+        if not self.path.exists():
+            return client_id, rows
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                self._needs_newline = not line.endswith("\n")
+                if not line.strip():
+                    continue
+                try:
+                    record = codec.loads(line)
+                except ValueError:
+                    # 写入中途退出时最后一行可能不完整
+                    continue
+                self._lines += 1
+                if record["op"] == "put":
+                    rows[record["id"]] = record["data"]
+                elif record["op"] == "del":
+                    rows.pop(record["id"], None)
+                elif record["op"] == "client_id":
+                    client_id = record["value"]
+        if self._lines > 2 * len(rows) + 64:
+            self._compact(client_id, rows)
+        return client_id, rows
+
+    def _compact(self, client_id: str, rows: Dict[str, str]) -> None:
+        records = [{"op": "client_id", "value": client_id}] if client_id else []
+        records += [{"op": "put", "id": key, "data": value} for key, value in rows.items()]
+        temp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.writelines(codec.dumps(record) + "\n" for record in records)
+        os.replace(temp_path, self.path)
+        self._lines = len(records)
+        self._needs_newline = False
+
+    def _append(self, records: List[dict]) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            if self._needs_newline:
+                f.write("\n")
+                self._needs_newline = False
+            f.writelines(codec.dumps(record) + "\n" for record in records)
+        self._lines += len(records)
+
+    def _write(self, rows: List[Tuple[str, str]], removed: List[str]) -> None:
+        self._append(
+            [{"op": "put", "id": key, "data": value} for key, value in rows]
+            + [{"op": "del", "id": key} for key in removed]
+        )
+
+    def _set_client_id(self, client_id: str) -> None:
+        self._append([{"op": "client_id", "value": client_id}])
@@ -2,7 +2,9 @@ from __future__ import annotations
 
 from typing import Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
+
+from .utils import codec
 
 
 class Text(BaseModel):
@@ -72,8 +74,30 @@ class SourceAttribution(BaseModel):
 
 
 class SearchResult(BaseModel):
-    content: list | str
+    """raw是bing返回的原始json文本,content在第一次读取时才会解析"""
+    raw: str = ""
     type: str = "SearchResult"
+    _content: list | str | None = PrivateAttr(default=None)
+
+    def __init__(self, content: list | str = None, **data):
+        super().__init__(**data)
+        self._content = content
+
+    @property
+    def content(self) -> list | str:
+        if self._content is None:
+            try:
+                data = codec.loads(self.raw)
+            except ValueError:
+                data = None
+            if isinstance(data, dict):
+                self._content = data.get("web_search_results", [])
+            else:
+                self._content = self.raw
+        return self._content
+
+    def dict(self, **kwargs):
+        return {**super().dict(**kwargs), "content": self.content}
 
     def __str__(self):
         string = "Search Result:\n"
@@ -101,3 +125,133 @@ class Limit(BaseModel):
 class NewChat(BaseModel):
     chat: dict
     type: str = 'NewChat'
+
+
+class DeleteResult(BaseModel):
+    conversation_id: str
+    success: bool
+    error: Optional[str] = None
+    type: str = 'DeleteResult'
+
+
+class _Event:
+    """不经过pydantic校验的轻量事件,字段和__str__与对应的模型相同,可以用to_model()转换成模型"""
+
+    __slots__ = ()
+    type: str = ""
+    model = BaseModel
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            setattr(self, name, kwargs.get(name))
+
+    def to_model(self):
+        return self.model(**{name: getattr(self, name) for name in self.__slots__})
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{self.__class__.__name__}({fields})"
+
+
+class TextEvent(_Event):
+    __slots__ = ("content",)
+    type = "Text"
+    model = Text
+
+    def __init__(self, content: str):
+        self.content = content
+
+    def __add__(self, other):
+        if isinstance(other, TextEvent):
+            return TextEvent(self.content + other.content)
+        else:
+            return NotImplemented
+
+    def __str__(self):
+        return str(self.content)
+
+
+class SuggestRelyEvent(_Event):
+    __slots__ = ("content",)
+    type = "SuggestRely"
+    model = SuggestRely
+
+    def __init__(self, content: str):
+        self.content = content
+
+    def __str__(self):
+        return str(self.content)
+
+
+class NoticeEvent(_Event):
+    __slots__ = ("content",)
+    type = "Notice"
+    model = Notice
+
+    def __init__(self, content: str):
+        self.content = content
+
+    def __str__(self):
+        return str(self.content)
+
+
+class ImageEvent(_Event):
+    __slots__ = ("name", "url", "base64")
+    type = "Image"
+    model = Image
+
+    def __init__(self, url: str, base64: Optional[str] = None, name: str = "image.png"):
+        self.name = name
+        self.url = url
+        self.base64 = base64
+
+    def __str__(self):
+        return f"![{self.name}]({self.url})"
+
+
+class SourceAttributionEvent(_Event):
+    __slots__ = ("display_name", "see_more_url", "image")
+    type = "SourceAttribution"
+    model = SourceAttribution
+
+    def __init__(
+            self,
+            see_more_url: str,
+            display_name: str = "Source",
+            image: Optional[ImageEvent] = None,
+    ):
+        self.display_name = display_name
+        self.see_more_url = see_more_url
+        self.image = image
+
+    def to_model(self):
+        return SourceAttribution(
+            display_name=self.display_name,
+            see_more_url=self.see_more_url,
+            image=self.image.to_model() if self.image else None,
+        )
+
+    def __str__(self):
+        _str_ = f"[{self.display_name}]({self.see_more_url})"
+        if self.image and self.image.url:
+            _str_ += f"\n![{self.display_name}]({self.image.url})"
+        return _str_
+
+
+class LimitEvent(_Event):
+    __slots__ = (
+        "max_num_user_messages",
+        "num_user_messages",
+        "max_num_long_doc_summary_user_messages",
+        "num_long_doc_summary_user_messages",
+    )
+    type = "Limit"
+    model = Limit
+
+    def __str__(self):
+        return str(f"\n{self.num_user_messages} of {self.max_num_user_messages}")
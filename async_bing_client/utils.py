@@ -1,35 +1,51 @@
 from __future__ import annotations
 
 import asyncio
-import base64
+import hashlib
 import http.cookies
 import json
 import locale
 import random
 import sys
+import time
 import urllib.parse
 import uuid
+from contextlib import nullcontext
 from contextvars import copy_context
-from datetime import datetime
-from functools import wraps, partial
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from functools import wraps, partial, lru_cache
 from io import BytesIO
 from pathlib import Path
 from typing import (
     TypeVar,
     Callable,
     Coroutine,
+    Any,
+    Awaitable,
+    Dict,
+    Hashable,
+    Tuple,
 )
 from typing import Union, Literal
 
 import aiohttp
-from PIL import Image, ImageOps
+from loguru import logger
+from PIL import Image, ImageFile
+from regex import regex
 from typing_extensions import ParamSpec
 
+from .cache import ImageCache
+from .imaging import compress_image_sync, ImageTooLarge
 from .const import ConversationStyle, LocationHint, IMAGE_HEADERS, FORWARDED_IP
 
 P = ParamSpec("P")
 R = TypeVar("R")
 
+# 下载图片链接的超时时间,以及识别图片头最多读取的字节数
+IMAGE_DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=60, sock_read=20)
+IMAGE_HEADER_LIMIT = 1024 * 1024
+
 
 def parse_proxy_url(url: str):
     parsed = urllib.parse.urlparse(url)
@@ -59,27 +75,183 @@ def format_personality(personality: str):
     )
 
 
-def async_retry(max_retries):
+# 这些状态码说明bing暂时不可用,可以稍后重试
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+class BingHTTPError(Exception):
+    """bing返回了错误的状态码,retry_after是响应头Retry-After中的秒数"""
+
+    def __init__(self, status: int, message: str = "", retry_after: float | None = None):
+        super().__init__(message or f"HTTP {status}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+async def check_response(response: aiohttp.ClientResponse) -> None:
+    """状态码>=400时抛出BingHTTPError"""
+    if response.status >= 400:
+        text = await response.text()
+        raise BingHTTPError(
+            response.status,
+            f"HTTP {response.status}: {text}",
+            parse_retry_after(response.headers.get("Retry-After")),
+        )
+
+
+def is_retryable(error: BaseException) -> bool:
+    """只有网络错误,超时和表示服务暂时不可用的状态码值得重试,鉴权失败和代码错误直接抛出"""
+    if isinstance(error, (BingHTTPError, aiohttp.ClientResponseError)):
+        return error.status in RETRYABLE_STATUS
+    return isinstance(
+        error,
+        (
+            aiohttp.ClientConnectionError,
+            aiohttp.ClientPayloadError,
+            asyncio.TimeoutError,
+        ),
+    )
+
+
+class RetryBudget:
+    """client级别的重试预算:每次失败消耗一个额度,每次成功恢复ratio个额度,
+    额度低于上限的一半时不再重试,避免故障期间重试把请求量成倍放大"""
+
+    def __init__(self, max_tokens: float = 20, ratio: float = 0.1):
+        self.max_tokens = max_tokens
+        self.ratio = ratio
+        self.tokens = max_tokens
+
+    def can_retry(self) -> bool:
+        return self.tokens > self.max_tokens / 2
+
+    def on_success(self) -> None:
+        self.tokens = min(self.tokens + self.ratio, self.max_tokens)
+
+    def on_failure(self) -> None:
+        self.tokens = max(self.tokens - 1, 0)
+
+
+def async_retry(
+        max_retries: int,
+        base_delay: float = 0.5,
+        max_delay: float = 10,
+        retryable: Callable[[BaseException], bool] = is_retryable,
+        breaker: str = None,
+):
+    """最多尝试max_retries次,每次重试前按指数退避加随机抖动等待,
+    只重试retryable判定为可重试的异常,被装饰的方法所属对象有retry_budget时还会受重试预算限制,
+    指定breaker时每次尝试都会经过所属对象breakers中对应的断路器,断路器打开时直接失败"""
+
     def decorator(func):
+        @wraps(func)
         async def wrapper(*args, **kwargs):
-            retries = 0
-            error = Exception("Unknown Error")
-            while retries < max_retries:
+            budget: RetryBudget | None = getattr(args[0], "retry_budget", None) if args else None
+            circuit = getattr(args[0], "breakers", {}).get(breaker) if breaker and args else None
+            attempt = 0
+            while True:
                 try:
-                    return await func(*args, **kwargs)
+                    with circuit.guard() if circuit is not None else nullcontext():
+                        result = await func(*args, **kwargs)
                 except Exception as e:
-                    retries += 1
-                    error = e
-            await asyncio.sleep(1)
-            raise Exception(f"Max Retry Exceed: {error}")
+                    attempt += 1
+                    if not retryable(e):
+                        raise
+                    if budget is not None:
+                        budget.on_failure()
+                    if attempt >= max_retries or (budget is not None and not budget.can_retry()):
+                        raise
+                    delay = random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+                    retry_after = getattr(e, "retry_after", None)
+                    if retry_after is not None:
+                        if retry_after > max_delay:
+                            raise
+                        delay = max(delay, retry_after)
+                    await asyncio.sleep(delay)
+                else:
+                    if budget is not None:
+                        budget.on_success()
+                    return result
 
         return wrapper
 
     return decorator
 
 
+class SingleFlight:
+    """合并相同key的并发调用:同一时间只有第一个调用真正执行,其余的调用等待并共享它的结果(或异常),
+    调用方被取消不会影响正在执行的调用,除非do时传入cancel_abandoned=True,
+    这时所有调用方都被取消后正在执行的调用也会被取消"""
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+        # 正在执行的调用 -> 等待它的调用方数量
+        self._waiters: Dict[asyncio.Future, int] = {}
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._calls
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    async def do(
+            self,
+            key: Hashable,
+            func: Callable[[], Awaitable[R]],
+            cancel_abandoned: bool = False,
+    ) -> R:
+        call = self._calls.get(key)
+        if call is None:
+            call = self._calls[key] = asyncio.ensure_future(func())
+            call.add_done_callback(partial(self._done, key))
+        self._waiters[call] = self._waiters.get(call, 0) + 1
+        try:
+            return await asyncio.shield(call)
+        finally:
+            remaining = self._waiters.pop(call) - 1
+            if remaining:
+                self._waiters[call] = remaining
+            elif cancel_abandoned and not call.done():
+                # 调用没有完成说明最后一个调用方也被取消了
+                call.cancel()
+
+    def _done(self, key: Hashable, call: asyncio.Future) -> None:
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        # 所有调用方都被取消时没有人读取异常,在这里读取避免asyncio的警告
+        if not call.cancelled():
+            call.exception()
+
+
+def single_flight(func):
+    """用所属对象的flights(SingleFlight)合并方法名和参数都相同的并发调用"""
+
+    @wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        key = (func.__name__, args, tuple(sorted(kwargs.items())))
+        return await self.flights.do(key, partial(func, self, *args, **kwargs))
+
+    return wrapper
+
+
 def get_ran_hex(length: int = 32) -> str:
-    return "".join(random.choice("0123456789abcdef") for _ in range(length))
+    return f"{random.getrandbits(length * 4):0{length}x}"
 
 
 def guess_locale() -> str:
@@ -91,8 +263,96 @@ def guess_locale() -> str:
     return loc.replace("_", "-")
 
 
+class JSONCodec:
+    """ChatHub帧的json编解码器,默认优先使用已安装的orjson或ujson,都没有时使用标准库json,
+    也可以通过use()指定后端或者传入自定义的loads/dumps"""
+
+    def __init__(self, backend: str = "auto"):
+        self.name = ""
+        self.loads: Callable[[str | bytes], Any] = json.loads
+        self.dumps: Callable[[Any], str] = partial(json.dumps, ensure_ascii=False)
+        self.use(backend)
+
+    def use(
+            self,
+            backend: Literal["auto", "orjson", "ujson", "json"] = "auto",
+            loads: Callable[[str | bytes], Any] = None,
+            dumps: Callable[[Any], str] = None,
+    ) -> JSONCodec:
+        if loads and dumps:
+            self.name, self.loads, self.dumps = "custom", loads, dumps
+            return self
+        if backend == "auto":
+            for name in ("orjson", "ujson"):
+                try:
+                    return self.use(name)
+                except ImportError:
+                    continue
+            return self.use("json")
+        if backend == "orjson":
+            import orjson
+
+            self.loads = orjson.loads
+            self.dumps = lambda obj: orjson.dumps(obj).decode("utf-8")
+        elif backend == "ujson":
+            import ujson
+
+            self.loads = ujson.loads
+            self.dumps = partial(
+                ujson.dumps, ensure_ascii=False, escape_forward_slashes=False
+            )
+        elif backend == "json":
+            self.loads = json.loads
+            self.dumps = partial(json.dumps, ensure_ascii=False)
+        else:
+            raise ValueError(f"Unknown json backend: {backend}")
+        self.name = backend
+        return self
+
+
+codec = JSONCodec()
+
+
 def append_identifier(msg: dict) -> str:
-    return json.dumps(msg, ensure_ascii=False) + "\x1e"
+    return codec.dumps(msg) + "\x1e"
+
+
+class TextDeltaDecoder:
+    """ChatHub推送的是累计的完整回复,这里只处理新增的后缀,返回和之前整段替换再切片完全一致的增量文本"""
+
+    # 以这些字符结尾时引用标记可能还没有推送完整,先不输出
+    HOLD_SUFFIXES = ("[", "]", "(", ")", "^", "1", "2", "3", "4", "5", "6", "7", "8", "9", "0")
+
+    def __init__(self):
+        self.raw_text = ""
+        self.text_length = 0
+
+    @staticmethod
+    def clean(text: str) -> str:
+        if "^" not in text:
+            return text
+        return (
+            text.replace("[^", "[")
+            .replace("^]", "]")
+            .replace("(^", "(")
+            .replace("^)", ")")
+        )
+
+    def feed(self, text: str) -> str | None:
+        """传入目前累计的完整文本,返回需要输出的增量,需要等待后续文本时返回None"""
+        if text.endswith(self.HOLD_SUFFIXES):
+            return None
+        raw_length = len(self.raw_text)
+        if raw_length and len(text) >= raw_length and text.startswith(self.raw_text):
+            # 上一次处理的文本不会以 [ ( ^ 结尾,所以引用标记不会跨越边界,只需要处理新增的部分
+            delta = self.clean(text[raw_length:])
+            self.text_length += len(delta)
+        else:
+            clean_text = self.clean(text)
+            delta = clean_text[self.text_length:]
+            self.text_length = len(clean_text)
+        self.raw_text = text
+        return delta
 
 
 def run_sync(call: Callable[P, R]) -> Callable[P, Coroutine[None, None, R]]:
@@ -115,42 +375,183 @@ def run_sync(call: Callable[P, R]) -> Callable[P, Coroutine[None, None, R]]:
 
 @run_sync
 def compress_image(infile: bytes) -> str:
-    img = Image.open(BytesIO(infile))
-    img = img.convert("RGB")
-    size = len(infile)
-    max_size = 1e6
-    if size <= max_size:
-        outfile = BytesIO()
-        img.save(outfile, format="JPEG", quality=80, optimize=True)
-        return base64.b64encode(outfile.getvalue()).decode("utf-8")
-    else:
-        ratio = (size / max_size) ** 0.6
-        new_width = int(img.width / ratio)
-        new_height = int(img.height / ratio)
-        img = ImageOps.fit(img, (new_width, new_height), method=Image.LANCZOS)
-        outfile = BytesIO()
-        img.save(outfile, format="JPEG", quality=80, optimize=True)
-        return base64.b64encode(outfile.getvalue()).decode("utf-8")
-
-
-async def process_image_to_base64(image: str | bytes | Path):
-    if isinstance(image, str):
-        if Path(image).is_file():
-            image = Path(image).read_bytes()
-        else:
+    return compress_image_sync(infile)
+
+
+async def download_image(
+    response: aiohttp.ClientResponse, max_bytes: int = None, chunk_size: int = 64 * 1024
+) -> Tuple[bytes, str]:
+    """分块读取图片链接的响应,返回内容和sha256,先检查Content-Type和Content-Length,
+    读取时用ImageFile.Parser尽早识别图片头,不是图片或者超过max_bytes时立即中止下载"""
+    await check_response(response)
+    content_type = response.headers.get("Content-Type", "")
+    if content_type and not content_type.startswith(("image/", "application/octet-stream")):
+        raise ValueError(f"{response.url} is not an image ({content_type})")
+    if max_bytes is not None and (response.content_length or 0) > max_bytes:
+        raise ImageTooLarge(
+            f"Image is {response.content_length} bytes, more than the limit of {max_bytes} bytes"
+        )
+    buffer = BytesIO()
+    digest = hashlib.sha256()
+    parser: ImageFile.Parser | None = ImageFile.Parser()
+    async for chunk in response.content.iter_chunked(chunk_size):
+        if max_bytes is not None and buffer.tell() + len(chunk) > max_bytes:
+            raise ImageTooLarge(f"Image is more than the limit of {max_bytes} bytes")
+        buffer.write(chunk)
+        digest.update(chunk)
+        if parser is not None:
+            try:
+                parser.feed(chunk)
+            except Exception as e:
+                raise ValueError(f"{response.url} is not a valid image: {e}") from e
+            if parser.image is not None:
+                # 只需要识别图片头,之后不再解码
+                width, height = parser.image.size
+                if Image.MAX_IMAGE_PIXELS and width * height > 2 * Image.MAX_IMAGE_PIXELS:
+                    raise ImageTooLarge(f"Image is too large: {width}x{height}")
+                parser = None
+            elif buffer.tell() > IMAGE_HEADER_LIMIT:
+                raise ValueError(f"{response.url} is not a valid image")
+    if parser is not None:
+        raise ValueError(f"{response.url} is not a valid image")
+    return buffer.getvalue(), digest.hexdigest()
+
+
+async def read_image(
+    image: str | bytes | Path,
+    session: aiohttp.ClientSession = None,
+    proxy=None,
+    cache: ImageCache = None,
+    max_bytes: int = None,
+) -> Tuple[bytes | None, str | None]:
+    """读取图片的内容,返回(内容, sha256),不是链接且没有传入cache时不计算sha256,
+    链接的ETag和缓存的相同(服务器返回304)时不会下载,返回的内容为None,
+    图片超过max_bytes时抛出ImageTooLarge,链接会在下载到max_bytes时中止"""
+    digest = None
+    if isinstance(image, str) and not Path(image).is_file():
+        if session is None:
             async with aiohttp.ClientSession() as session:
-                async with session.get(image) as response:
-                    image = await response.read()
-    elif isinstance(image, Path):
-        image = image.read_bytes()
+                return await read_image(image, session, proxy, cache, max_bytes)
+        url = image
+        cached = cache.urls.get(url) if cache is not None else None
+        headers = {"If-None-Match": cached[0]} if cached else None
+        async with session.get(
+            url, proxy=proxy, headers=headers, timeout=IMAGE_DOWNLOAD_TIMEOUT
+        ) as response:
+            if cached and response.status == 304:
+                return None, cached[1]
+            image, digest = await download_image(response, max_bytes)
+            etag = response.headers.get("ETag")
+        if cache is not None and etag:
+            cache.urls.set(url, (etag, digest))
+        return image, digest
+    elif isinstance(image, (str, Path)):
+        path = Path(image)
+        if max_bytes is not None and path.stat().st_size > max_bytes:
+            raise ImageTooLarge(
+                f"Image is {path.stat().st_size} bytes, more than the limit of {max_bytes} bytes"
+            )
+        image = path.read_bytes()
     elif isinstance(image, bytes):
         pass
     else:
         raise TypeError("image must be str, Path, or bytes")
+    if cache is not None:
+        digest = cache.digest(image)
+    return image, digest
+
 
+async def process_image_to_base64(
+    image: str | bytes | Path, session: aiohttp.ClientSession = None, proxy=None
+):
+    image, _ = await read_image(image, session, proxy)
     return await compress_image(image)
 
 
+async def upload_image(
+    client,
+    image: str | bytes | Path,
+    conversation_id: str,
+    conversation_style: ConversationStyle,
+) -> str:
+    """压缩并上传图片到kblob,返回blobId,相同内容的图片会直接使用client.image_cache中的结果"""
+    cache: ImageCache | None = client.image_cache
+    max_bytes = client.image_executor.max_input_bytes
+    data, digest = await read_image(
+        image, client.image_session, client.proxy, cache, max_bytes
+    )
+    img_base64 = None
+    if cache is not None:
+        blob_id = cache.blobs.get(digest)
+        if blob_id:
+            return blob_id
+        img_base64 = cache.compressed.get(digest)
+    if img_base64 is None:
+        if data is None:
+            # ETag没有变化,但是压缩结果已经被淘汰,只能重新下载
+            cache.urls.pop(image)
+            data, digest = await read_image(
+                image, client.image_session, client.proxy, cache, max_bytes
+            )
+        img_base64 = await client.image_executor.compress(data)
+        if cache is not None:
+            cache.compressed.set(digest, img_base64, len(img_base64))
+
+    writer = aiohttp.MultipartWriter()
+
+    part_knowledge_request = writer.append(
+        json.dumps(
+            {
+                "imageInfo": {},
+                "knowledgeRequest": {
+                    "invokedSkills": ["ImageById"],
+                    "subscriptionId": "Bing.Chat.Multimodal",
+                    "invokedSkillsRequestData": {"enableFaceBlur": False},
+                    "convoData": {
+                        "convoid": conversation_id,
+                        "convotone": conversation_style.name,
+                    },
+                },
+            }
+        )
+    )
+
+    part_knowledge_request.set_content_disposition(
+        "form-data", name="knowledgeRequest"
+    )
+
+    part_image_base64 = writer.append(img_base64)
+    part_image_base64.set_content_disposition("form-data", name="imageBase64")
+
+    with client.breakers["kblob"].guard():
+        async with client.session.post(
+            "https://www.bing.com/images/kblob",
+            headers=IMAGE_HEADERS,
+            data=writer,
+            proxy=client.proxy,
+        ) as response:
+            if response.status != 200:
+                text = await response.text()
+                message = f"Failed to upload image: HTTP {response.status} from {response.url}: {text}"
+                logger.error(message)
+                raise BingHTTPError(
+                    response.status,
+                    message,
+                    parse_retry_after(response.headers.get("Retry-After")),
+                )
+            try:
+                response_json = await response.json()
+                blob_id = response_json["blobId"]
+            except json.decoder.JSONDecodeError as exc:
+                text = await response.text()
+                message = f"Failed to upload image: invalid response from {response.url}: {text}"
+                logger.error(message)
+                raise Exception(message) from exc
+    if cache is not None and blob_id:
+        cache.blobs.set(digest, blob_id)
+    return blob_id
+
+
 def process_cookie(cookie: str | Path | list[dict]):
     def load_cookie_from_file(path: Union[str, Path]):
         with open(Path(path), "r") as f:
@@ -195,7 +596,159 @@ def get_location_hint_from_locale(locale: str) -> Union[dict, None]:
     return hint.get("LocationHint")
 
 
-async def build_chat_request(
+# 请求模板中每轮对话都会变化的字段,模板序列化时先用占位符代替
+CHAT_REQUEST_FIELDS = (
+    "traceId",
+    "isStartOfSession",
+    "requestId",
+    "timestamp",
+    "text",
+    "messageExtra",
+    "conversationId",
+    "participantId",
+    "argumentExtra",
+    "invocationId",
+)
+
+
+class ChatRequestTemplate:
+    """一种(对话风格, 地区)的ChatHub请求模板,不变的部分只构建和序列化一次,
+    encode时只需要把每轮对话变化的字段(已经编码好的json片段)拼接到预先序列化好的片段之间,
+    messageExtra和argumentExtra是可选字段,为空字符串时不输出"""
+
+    def __init__(self, conversation_style: ConversationStyle, locale: str):
+        self.conversation_style = conversation_style
+        self.locale = locale
+        marks = {name: f"\x00{name}\x00" for name in CHAT_REQUEST_FIELDS}
+        struct = {
+            "arguments": [
+                {
+                    "source": "cib",
+                    "optionsSets": conversation_style.value,
+                    "allowedMessageTypes": [
+                        "ActionRequest",
+                        "Chat",
+                        "Context",
+                        "InternalSearchQuery",
+                        "InternalSearchResult",
+                        "Disengaged",
+                        "InternalLoaderMessage",
+                        "Progress",
+                        "RenderCardRequest",
+                        "AdsQuery",
+                        "SemanticSerp",
+                        "GenerateContentQuery",
+                        "SearchQuery",
+                    ],
+                    "sliceIds": [
+                        "628ajcopus0",
+                        "scdivetr",
+                        "tts3cf",
+                        "wrapuxslimc",
+                        "gaincrrev",
+                        "kcimgov2cf",
+                        "0731ziv2s0",
+                        "707enpcktrk",
+                        "0518logos",
+                        "0510wow",
+                        "wowcds",
+                        "727udtupm",
+                        "815enftshrcs0",
+                    ],
+                    "verbosity": "verbose",
+                    "scenario": "SERP",
+                    "plugins": [],
+                    "traceId": marks["traceId"],
+                    "isStartOfSession": marks["isStartOfSession"],
+                    "requestId": marks["requestId"],
+                    "message": {
+                        "locale": locale,
+                        "market": locale,
+                        "region": str(locale[-2:]).upper(),
+                        "location": "lat:47.639557;long:-122.128159;re=1000m;",
+                        "locationHints": get_location_hint_from_locale(locale),
+                        "userIpAddress": FORWARDED_IP,
+                        "timestamp": marks["timestamp"],
+                        "author": "user",
+                        "inputMethod": "Keyboard",
+                        "text": marks["text"],
+                        "messageType": "Chat",
+                        "messageId": marks["requestId"],
+                        "requestId": marks["requestId"],
+                        marks["messageExtra"]: marks["messageExtra"],
+                    },
+                    "tone": conversation_style.name.capitalize(),
+                    "spokenTextMode": "None",
+                    "conversationId": marks["conversationId"],
+                    "participant": {
+                        "id": marks["participantId"],
+                    },
+                    marks["argumentExtra"]: marks["argumentExtra"],
+                },
+            ],
+            "invocationId": marks["invocationId"],
+            "target": "chat",
+            "type": 4,
+        }
+        encoded = codec.dumps(struct)
+        # 编码器使用的分隔符,可选字段连同前面的分隔符一起替换
+        self.separator = codec.dumps([0, 0])[2:-2]
+        placeholders = {}
+        for name, mark in marks.items():
+            placeholder = codec.dumps(mark)
+            encoded = encoded.replace(
+                self.separator + codec.dumps({mark: mark})[1:-1], placeholder
+            )
+            placeholders[placeholder] = name
+        parts = regex.split(
+            "(" + "|".join(regex.escape(placeholder) for placeholder in placeholders) + ")",
+            encoded,
+        )
+        self.fragments = parts[::2]
+        self.names = [placeholders[placeholder] for placeholder in parts[1::2]]
+
+    def extra(self, fields: dict) -> str:
+        """编码可选字段"""
+        if not fields:
+            return ""
+        return self.separator + codec.dumps(fields)[1:-1]
+
+    def encode(self, fields: Dict[str, str]) -> str:
+        parts = [self.fragments[0]]
+        for name, fragment in zip(self.names, self.fragments[1:]):
+            parts.append(fields[name])
+            parts.append(fragment)
+        return "".join(parts)
+
+
+@lru_cache(maxsize=64)
+def _chat_request_template(
+        conversation_style: ConversationStyle, locale: str, dumps: Callable
+) -> ChatRequestTemplate:
+    # dumps作为缓存的key,切换json后端后重新生成模板
+    return ChatRequestTemplate(conversation_style, locale)
+
+
+def get_chat_request_template(
+        conversation_style: ConversationStyle, locale: str
+) -> ChatRequestTemplate:
+    return _chat_request_template(conversation_style, locale, codec.dumps)
+
+
+@lru_cache(maxsize=None)
+def _format_utc_offset(seconds: int) -> str:
+    sign = "+" if seconds >= 0 else "-"
+    hours, minutes = divmod(abs(seconds) // 60, 60)
+    return f"{sign}{hours:02d}:{minutes:02d}"
+
+
+def get_timestamp() -> str:
+    """本地时间,格式如2023-09-01T12:00:00+08:00"""
+    now = time.localtime()
+    return time.strftime("%Y-%m-%dT%H:%M:%S", now) + _format_utc_offset(now.tm_gmtoff)
+
+
+async def build_chat_frame(
     client,
     prompt: str,
     chat_data: dict,
@@ -204,7 +757,9 @@ async def build_chat_request(
     image: str | bytes | Path = None,
     personality=None,
     locale=guess_locale(),
-):
+) -> str:
+    """构建发送给ChatHub的帧(已经带上\\x1e),和append_identifier(await build_chat_request(...))的内容相同,
+    但是只编码每轮对话变化的字段"""
     if "message" in chat_data.keys():
         is_start_of_conversation = False
     else:
@@ -212,150 +767,27 @@ async def build_chat_request(
 
     if isinstance(conversation_style, str):
         conversation_style = getattr(ConversationStyle, conversation_style)
+    template = get_chat_request_template(conversation_style, locale)
 
-    options_set = conversation_style.value
-
-    message_id = str(uuid.uuid4())
-
-    timezone_offset = datetime.now() - datetime.utcnow()
-
-    # Get the offset in hours and minutes
-    offset_hours = int(timezone_offset.total_seconds() // 3600)
-    offset_minutes = int((timezone_offset.total_seconds() % 3600) // 60)
-
-    # Format the offset as a string
-    offset_string = f"{offset_hours:+03d}:{offset_minutes:02d}"
-
-    # Get current time
-    timestamp = datetime.now().strftime("%Y-%m-%dT%H:%M:%S") + offset_string
-    struct = {
-        "arguments": [
-            {
-                "source": "cib",
-                "optionsSets": options_set,
-                "allowedMessageTypes": [
-                    "ActionRequest",
-                    "Chat",
-                    "Context",
-                    "InternalSearchQuery",
-                    "InternalSearchResult",
-                    "Disengaged",
-                    "InternalLoaderMessage",
-                    "Progress",
-                    "RenderCardRequest",
-                    "AdsQuery",
-                    "SemanticSerp",
-                    "GenerateContentQuery",
-                    "SearchQuery",
-                ],
-                "sliceIds": [
-                    "628ajcopus0",
-                    "scdivetr",
-                    "tts3cf",
-                    "wrapuxslimc",
-                    "gaincrrev",
-                    "kcimgov2cf",
-                    "0731ziv2s0",
-                    "707enpcktrk",
-                    "0518logos",
-                    "0510wow",
-                    "wowcds",
-                    "727udtupm",
-                    "815enftshrcs0",
-                ],
-                "verbosity": "verbose",
-                "scenario": "SERP",
-                "plugins": [],
-                "traceId": str(get_ran_hex()),
-                "isStartOfSession": is_start_of_conversation,
-                "requestId": message_id,
-                "message": {
-                    "locale": locale,
-                    "market": locale,
-                    "region": str(locale[-2:]).upper(),
-                    "location": "lat:47.639557;long:-122.128159;re=1000m;",
-                    "locationHints": get_location_hint_from_locale(locale),
-                    "userIpAddress": FORWARDED_IP,
-                    "timestamp": timestamp,
-                    "author": "user",
-                    "inputMethod": "Keyboard",
-                    "text": prompt,
-                    "messageType": "Chat",
-                    "messageId": message_id,
-                    "requestId": message_id,
-                },
-                "tone": conversation_style.name.capitalize(),
-                "spokenTextMode": "None",
-                "conversationId": chat_data["conversationId"],
-                "participant": {
-                    "id": client.client_id,
-                },
-            },
-        ],
-        "invocationId": str(client.sent_times),
-        "target": "chat",
-        "type": 4,
-    }
+    message_id = f'"{uuid.uuid4()}"'
+    message_extra = {}
+    argument_extra = {}
     conversation_signature = chat_data.get("conversationSignature")
     if conversation_signature:
-        struct["arguments"][0]["conversationSignature"] = conversation_signature
+        argument_extra["conversationSignature"] = conversation_signature
     if image:
-        blob_id = ""
-        async with aiohttp.ClientSession(cookie_jar=client.cookie_jar) as session:
-            img_base64 = await process_image_to_base64(image)
-
-            writer = aiohttp.MultipartWriter()
-
-            part_knowledge_request = writer.append(
-                json.dumps(
-                    {
-                        "imageInfo": {},
-                        "knowledgeRequest": {
-                            "invokedSkills": ["ImageById"],
-                            "subscriptionId": "Bing.Chat.Multimodal",
-                            "invokedSkillsRequestData": {"enableFaceBlur": False},
-                            "convoData": {
-                                "convoid": chat_data["conversationId"],
-                                "convotone": conversation_style.name,
-                            },
-                        },
-                    }
-                )
-            )
-
-            part_knowledge_request.set_content_disposition(
-                "form-data", name="knowledgeRequest"
-            )
-
-            part_image_base64 = writer.append(img_base64)
-            part_image_base64.set_content_disposition("form-data", name="imageBase64")
-
-            async with session.post(
-                "https://www.bing.com/images/kblob", headers=IMAGE_HEADERS, data=writer
-            ) as response:
-                if response.status != 200:
-                    print(f"Status code: {response.status}")
-                    text = await response.text()
-                    print(text)
-                    print(str(response.url))
-                    raise Exception("Authentication failed")
-                try:
-                    response_json = await response.json()
-                    blob_id = response_json["blobId"]
-                except json.decoder.JSONDecodeError as exc:
-                    text = await response.text()
-                    print(text)
-                    raise Exception("Authentication failed") from exc
-
+        blob_id = await upload_image(
+            client, image, chat_data["conversationId"], conversation_style
+        )
         if blob_id:
-            struct["arguments"][0]["message"]["imageUrl"] = (
+            message_extra["imageUrl"] = (
                 "https://www.bing.com/images/blob?bcid=" + blob_id
             )
-            struct["arguments"][0]["message"]["originalImageUrl"] = (
+            message_extra["originalImageUrl"] = (
                 "https://www.bing.com/images/blob?bcid=" + blob_id
             )
     if personality and is_start_of_conversation:
-        struct["arguments"][0]["previousMessages"] = [
+        argument_extra["previousMessages"] = [
             {
                 "author": "user",
                 "description": format_personality(personality),
@@ -364,5 +796,34 @@ async def build_chat_request(
                 "messageId": "discover-web--page-ping-mriduna-----",
             },
         ]
+    return template.encode(
+        {
+            "traceId": f'"{get_ran_hex()}"',
+            "isStartOfSession": "true" if is_start_of_conversation else "false",
+            "requestId": message_id,
+            "timestamp": f'"{get_timestamp()}"',
+            "text": codec.dumps(prompt),
+            "messageExtra": template.extra(message_extra),
+            "conversationId": codec.dumps(chat_data["conversationId"]),
+            "participantId": codec.dumps(client.client_id),
+            "argumentExtra": template.extra(argument_extra),
+            "invocationId": f'"{client.sent_times}"',
+        }
+    ) + "\x1e"
+
 
-    return struct
+async def build_chat_request(
+    client,
+    prompt: str,
+    chat_data: dict,
+    conversation_style: ConversationStyle
+    | Literal["creative", "balanced", "precise"] = ConversationStyle.Precise,
+    image: str | bytes | Path = None,
+    personality=None,
+    locale=guess_locale(),
+) -> dict:
+    """兼容旧的调用方式,返回请求的dict,发送时直接使用build_chat_frame更快"""
+    frame = await build_chat_frame(
+        client, prompt, chat_data, conversation_style, image, personality, locale
+    )
+    return codec.loads(frame[:-1])
@@ -0,0 +1,175 @@
+"""对比原来每轮重新构建整个请求dict再编码和使用预先编译的模板(build_chat_frame)构建ChatHub请求帧的吞吐量,
+对每个已安装的json后端分别测试,并检查两者除了每轮随机的字段外内容和键的顺序都相同
+
+用法: python benchmarks/bench_chat_request.py [--frames 20000]
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import uuid
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from async_bing_client.const import ConversationStyle, FORWARDED_IP  # noqa: E402
+from async_bing_client.utils import (  # noqa: E402
+    build_chat_frame,
+    build_chat_request,
+    codec,
+    get_location_hint_from_locale,
+)
+
+
+class FakeClient:
+    client_id = "1234567890"
+    sent_times = 3
+
+
+CHAT_DATA = {"conversationId": "51D|BingProd|0123456789ABCDEF", "conversationSignature": "sig"}
+
+
+def old_build_chat_request(client, prompt, chat_data, conversation_style, locale) -> str:
+    """改动之前的做法(不含图片和人格): 每轮重新构建整个dict,逐字符生成traceId,用两次datetime计算时区"""
+    is_start_of_conversation = chat_data.get("isStart", True)
+    message_id = str(uuid.uuid4())
+    timezone_offset = datetime.now() - datetime.utcnow()
+    offset_hours = int(timezone_offset.total_seconds() // 3600)
+    offset_minutes = int((timezone_offset.total_seconds() % 3600) // 60)
+    offset_string = f"{offset_hours:+03d}:{offset_minutes:02d}"
+    timestamp = datetime.now().strftime("%Y-%m-%dT%H:%M:%S") + offset_string
+    struct = {
+        "arguments": [
+            {
+                "source": "cib",
+                "optionsSets": conversation_style.value,
+                "allowedMessageTypes": [
+                    "ActionRequest",
+                    "Chat",
+                    "Context",
+                    "InternalSearchQuery",
+                    "InternalSearchResult",
+                    "Disengaged",
+                    "InternalLoaderMessage",
+                    "Progress",
+                    "RenderCardRequest",
+                    "AdsQuery",
+                    "SemanticSerp",
+                    "GenerateContentQuery",
+                    "SearchQuery",
+                ],
+                "sliceIds": [
+                    "628ajcopus0",
+                    "scdivetr",
+                    "tts3cf",
+                    "wrapuxslimc",
+                    "gaincrrev",
+                    "kcimgov2cf",
+                    "0731ziv2s0",
+                    "707enpcktrk",
+                    "0518logos",
+                    "0510wow",
+                    "wowcds",
+                    "727udtupm",
+                    "815enftshrcs0",
+                ],
+                "verbosity": "verbose",
+                "scenario": "SERP",
+                "plugins": [],
+                "traceId": "".join(random.choice("0123456789abcdef") for _ in range(32)),
+                "isStartOfSession": is_start_of_conversation,
+                "requestId": message_id,
+                "message": {
+                    "locale": locale,
+                    "market": locale,
+                    "region": str(locale[-2:]).upper(),
+                    "location": "lat:47.639557;long:-122.128159;re=1000m;",
+                    "locationHints": get_location_hint_from_locale(locale),
+                    "userIpAddress": FORWARDED_IP,
+                    "timestamp": timestamp,
+                    "author": "user",
+                    "inputMethod": "Keyboard",
+                    "text": prompt,
+                    "messageType": "Chat",
+                    "messageId": message_id,
+                    "requestId": message_id,
+                },
+                "tone": conversation_style.name.capitalize(),
+                "spokenTextMode": "None",
+                "conversationId": chat_data["conversationId"],
+                "participant": {
+                    "id": client.client_id,
+                },
+            },
+        ],
+        "invocationId": str(client.sent_times),
+        "target": "chat",
+        "type": 4,
+    }
+    conversation_signature = chat_data.get("conversationSignature")
+    if conversation_signature:
+        struct["arguments"][0]["conversationSignature"] = conversation_signature
+    return codec.dumps(struct) + "\x1e"
+
+
+def normalize(frame: str) -> str:
+    """去掉每轮随机的字段,保留键的顺序"""
+    data = json.loads(frame[:-1])
+    arguments = data["arguments"][0]
+    arguments["traceId"] = arguments["requestId"] = None
+    for key in ("timestamp", "messageId", "requestId"):
+        arguments["message"][key] = None
+    return json.dumps(data)
+
+
+async def bench(build, frames: int) -> float:
+    for _ in range(500):
+        await build()
+    start = perf_counter()
+    for _ in range(frames):
+        await build()
+    return perf_counter() - start
+
+
+async def run(frames: int) -> None:
+    client = FakeClient()
+    args = (client, "What is the weather like in Beijing today?", CHAT_DATA)
+    style, locale = ConversationStyle.Creative, "zh-CN"
+
+    async def old():
+        return old_build_chat_request(*args, style, locale)
+
+    async def new():
+        return await build_chat_frame(*args, style, None, None, locale)
+
+    async def compat():
+        return await build_chat_request(*args, style, None, None, locale)
+
+    assert normalize(await old()) == normalize(await new()), "frames differ"
+    print(f"{codec.name}:")
+    for name, build in (
+            ("dict + dumps (old)", old),
+            ("build_chat_frame", new),
+            ("build_chat_request", compat),
+    ):
+        seconds = await bench(build, frames)
+        print(f"  {name:<20} {frames / seconds:10,.0f} frames/s  {seconds / frames * 1e6:6.1f} us/frame")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=20000)
+    args = parser.parse_args()
+    for backend in ("json", "ujson", "orjson"):
+        try:
+            codec.use(backend)
+        except ImportError:
+            continue
+        asyncio.run(run(args.frames))
+
+
+if __name__ == "__main__":
+    main()
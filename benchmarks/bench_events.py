@@ -0,0 +1,56 @@
+"""对比每个token创建pydantic模型Text和轻量事件TextEvent的耗时,以及用tracemalloc统计的每个token的内存分配
+
+用法: python benchmarks/bench_events.py [--tokens 100000]
+"""
+import argparse
+import gc
+import sys
+import tracemalloc
+from pathlib import Path
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from async_bing_client.type import Text, TextEvent  # noqa: E402
+
+
+def make_tokens(count: int):
+    return [f"token{i % 1000} " for i in range(count)]
+
+
+def time_per_token(event_type, tokens) -> float:
+    start = perf_counter()
+    for token in tokens:
+        event_type(content=token)
+    return (perf_counter() - start) / len(tokens)
+
+
+def allocations_per_token(event_type, tokens):
+    """创建的事件保留下来时每个token分配的字节数"""
+    gc.collect()
+    tracemalloc.start()
+    events = [event_type(content=token) for token in tokens]
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # 减去保存事件的列表本身
+    return (current - sys.getsizeof(events)) / len(tokens)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", type=int, default=100000)
+    args = parser.parse_args()
+
+    tokens = make_tokens(args.tokens)
+    print(f"{args.tokens} tokens")
+    for event_type in (Text, TextEvent):
+        seconds = time_per_token(event_type, tokens)
+        retained = allocations_per_token(event_type, tokens)
+        print(
+            f"  {event_type.__name__:<10} {seconds * 1e6:6.2f} us/token"
+            f"  {retained:6.0f} B/token"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""对比原来的compress_image和compress_image_sync/ImageExecutor(线程池和进程池)压缩图片的耗时,
+在生成的手机照片大小的JPEG,走原样上传路径的小JPEG和PNG截图上测试,并检查两者输出的图片尺寸相同
+
+用法: python benchmarks/bench_imaging.py [--count 3] [--repeat 3] [--workers 2]
+"""
+import argparse
+import asyncio
+import base64
+import random
+import sys
+from io import BytesIO
+from pathlib import Path
+from time import perf_counter
+
+from PIL import Image, ImageDraw, ImageFilter, ImageOps
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from async_bing_client.imaging import ImageExecutor, compress_image_sync  # noqa: E402
+
+
+def old_compress_image(infile: bytes) -> str:
+    """改动之前utils.compress_image中的做法: 总是完整解码,不超过1MB的图片也重新编码"""
+    img = Image.open(BytesIO(infile))
+    img = img.convert("RGB")
+    size = len(infile)
+    max_size = 1e6
+    if size <= max_size:
+        outfile = BytesIO()
+        img.save(outfile, format="JPEG", quality=80, optimize=True)
+        return base64.b64encode(outfile.getvalue()).decode("utf-8")
+    else:
+        ratio = (size / max_size) ** 0.6
+        new_width = int(img.width / ratio)
+        new_height = int(img.height / ratio)
+        img = ImageOps.fit(img, (new_width, new_height), method=Image.LANCZOS)
+        outfile = BytesIO()
+        img.save(outfile, format="JPEG", quality=80, optimize=True)
+        return base64.b64encode(outfile.getvalue()).decode("utf-8")
+
+
+def make_photo(size, seed: int, quality: int) -> bytes:
+    """生成类似照片的图片: 平滑的色彩渐变加上噪点(模拟传感器噪声和纹理)"""
+    rng = random.Random(seed)
+    width, height = size
+    small = Image.new("RGB", (16, 12))
+    small.putdata([tuple(rng.randrange(256) for _ in range(3)) for _ in range(16 * 12)])
+    img = small.resize(size, Image.BICUBIC)
+    noise = Image.effect_noise(size, 40).convert("RGB")
+    img = Image.blend(img, noise, 0.15)
+    outfile = BytesIO()
+    img.save(outfile, format="JPEG", quality=quality)
+    return outfile.getvalue()
+
+
+def make_screenshot(seed: int) -> bytes:
+    """生成类似手机截图的PNG: 纯色背景上的文字行,色块和一张照片"""
+    rng = random.Random(seed)
+    img = Image.new("RGB", (1170, 2532), (250, 250, 250))
+    draw = ImageDraw.Draw(img)
+    y = 40
+    while y < 2500:
+        if rng.random() < 0.15:
+            color = tuple(rng.randrange(256) for _ in range(3))
+            draw.rectangle((40, y, 1130, y + rng.randint(150, 400)), fill=color)
+            y += 420
+        else:
+            for x in range(40, rng.randint(400, 1130), 24):
+                draw.text((x, y), rng.choice("abcdefghijklmnopqrstuvwxyz"), fill=(30, 30, 30))
+            y += 44
+    img = img.filter(ImageFilter.SMOOTH)
+    photo = Image.open(BytesIO(make_photo((1090, 820), seed, 90)))
+    img.paste(photo, (40, 600))
+    outfile = BytesIO()
+    img.save(outfile, format="PNG")
+    return outfile.getvalue()
+
+
+def make_corpus(count: int):
+    return {
+        "4032x3024 JPEG (phone photo)": [make_photo((4032, 3024), i, 92) for i in range(count)],
+        "1280x960 JPEG (passthrough)": [make_photo((1280, 960), i, 75) for i in range(count)],
+        "1170x2532 PNG (screenshot)": [make_screenshot(i) for i in range(count)],
+    }
+
+
+def decoded_size(img_base64: str):
+    return Image.open(BytesIO(base64.b64decode(img_base64))).size
+
+
+def time_per_image(compress, images, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = perf_counter()
+        for data in images:
+            compress(data)
+        best = min(best, (perf_counter() - start) / len(images))
+    return best
+
+
+async def throughput(executor: ImageExecutor, images) -> float:
+    await executor.compress(images[0])  # 预先启动线程或进程
+    start = perf_counter()
+    await asyncio.gather(*[executor.compress(data) for data in images])
+    seconds = perf_counter() - start
+    executor.close()
+    return len(images) / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=3, help="每种图片生成的数量")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=2)
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.count)
+    for name, images in corpus.items():
+        for data in images:
+            old, new = old_compress_image(data), compress_image_sync(data)
+            assert decoded_size(old) == decoded_size(new), f"{name}: output sizes differ"
+        average = sum(map(len, images)) / len(images)
+        old_ms = time_per_image(old_compress_image, images, args.repeat) * 1000
+        new_ms = time_per_image(compress_image_sync, images, args.repeat) * 1000
+        print(f"{name}, {average / 1e6:.2f} MB, output {decoded_size(new)[0]}x{decoded_size(new)[1]}")
+        print(f"  compress_image (old)  {old_ms:8.1f} ms/img")
+        print(f"  compress_image_sync   {new_ms:8.1f} ms/img  ({old_ms / new_ms:.1f}x)")
+
+    images = [data for images in corpus.values() for data in images] * 2
+    for use_processes in (False, True):
+        executor = ImageExecutor(args.workers, use_processes=use_processes)
+        rate = asyncio.run(throughput(executor, images))
+        kind = "processes" if use_processes else "threads"
+        print(f"ImageExecutor({args.workers} {kind}) {rate:6.1f} img/s over {len(images)} mixed images")
+
+
+if __name__ == "__main__":
+    main()
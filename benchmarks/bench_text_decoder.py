@@ -0,0 +1,88 @@
+"""对比TextDeltaDecoder和原来每帧整段替换再切片的做法在长回复上的耗时,并检查两者输出完全一致
+
+用法: python benchmarks/bench_text_decoder.py [--chars 26000] [--repeat 5]
+"""
+import argparse
+import random
+import sys
+from pathlib import Path
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from async_bing_client.utils import TextDeltaDecoder  # noqa: E402
+
+HOLD_SUFFIXES = ("[", "]", "(", ")", "^", "1", "2", "3", "4", "5", "6", "7", "8", "9", "0")
+
+
+def old_decode(frames):
+    """改动之前client中的做法: 每一帧都清理整段累计文本,再切出新增的部分"""
+    last_text = ""
+    deltas = []
+    for plain_text in frames:
+        if plain_text.endswith(HOLD_SUFFIXES):
+            continue
+        plain_text = (
+            plain_text.replace("[^", "[")
+            .replace("^]", "]")
+            .replace("(^", "(")
+            .replace("^)", ")")
+        )
+        deltas.append(plain_text[len(last_text):])
+        last_text = plain_text
+    return deltas
+
+
+def new_decode(frames):
+    decoder = TextDeltaDecoder()
+    deltas = []
+    for text in frames:
+        delta = decoder.feed(text)
+        if delta is not None:
+            deltas.append(delta)
+    return deltas
+
+
+def make_frames(chars: int, seed: int = 0):
+    """生成bing推送的累计文本,每帧新增几个字符,其中夹杂[^1^]形式的引用标记"""
+    rng = random.Random(seed)
+    text = ""
+    frames = []
+    while len(text) < chars:
+        if rng.random() < 0.05:
+            piece = f"[^{rng.randint(1, 9)}^]"
+        else:
+            piece = "".join(rng.choice("abcdefghij klmnop,.") for _ in range(rng.randint(3, 10)))
+        # 引用标记可能被拆到多帧中推送
+        for end in range(1, len(piece) + 1) if piece.startswith("[^") else [len(piece)]:
+            frames.append(text + piece[:end])
+        text += piece
+    return frames
+
+
+def bench(decode, frames, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = perf_counter()
+        decode(frames)
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chars", type=int, default=26000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    frames = make_frames(args.chars)
+    assert old_decode(frames) == new_decode(frames), "outputs differ"
+    old = bench(old_decode, frames, args.repeat)
+    new = bench(new_decode, frames, args.repeat)
+    print(f"{len(frames[-1])} chars in {len(frames)} frames (best of {args.repeat})")
+    print(f"  replace + slice    {old * 1000:8.1f} ms")
+    print(f"  TextDeltaDecoder   {new * 1000:8.1f} ms  ({old / new:.0f}x)")
+
+
+if __name__ == "__main__":
+    main()
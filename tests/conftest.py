@@ -0,0 +1,78 @@
+import asyncio
+import json
+from collections import Counter
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+from async_bing_client import Bing_Client
+
+
+class FakeResponse:
+    def __init__(self, data: dict = None, headers: dict = None):
+        self.status = 200
+        self.headers = headers or {}
+        self._data = data or {}
+
+    async def json(self):
+        return self._data
+
+    async def __aenter__(self):
+        # 留出时间让并发的调用叠在一起
+        await asyncio.sleep(0.01)
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class FakeSession:
+    """代替aiohttp.ClientSession,记录每个(接口, 会话)上的请求次数,会话列表中有chat_ids中的会话"""
+
+    closed = False
+    chat_ids = ["c1", "c2", "c3"]
+
+    def __init__(self):
+        self.calls = Counter()
+
+    def get(self, url: str, **kwargs) -> FakeResponse:
+        parsed = urlparse(url)
+        conversation_id = parse_qs(parsed.query).get("conversationId", [None])[0]
+        self.calls[(parsed.path, conversation_id)] += 1
+        if parsed.path.endswith("/chats"):
+            return FakeResponse(
+                {
+                    "clientId": "client",
+                    "chats": [
+                        {"conversationId": cid, "conversationSignature": "sig"}
+                        for cid in self.chat_ids
+                    ],
+                }
+            )
+        if parsed.path.endswith("/create"):
+            return FakeResponse(headers={"X-Sydney-EncryptedConversationSignature": "token"})
+        return FakeResponse({"messages": []})
+
+    def post(self, url: str, data: str = None, **kwargs) -> FakeResponse:
+        conversation_id = json.loads(data).get("conversationId") if data else None
+        self.calls[(urlparse(url).path, conversation_id)] += 1
+        return FakeResponse()
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def run():
+    def run(test):
+        async def main():
+            client = Bing_Client("[]")
+            session = client._session = FakeSession()
+            try:
+                await test(client, session)
+            finally:
+                await client.aclose()
+
+        asyncio.run(main())
+
+    return run
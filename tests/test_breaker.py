@@ -0,0 +1,49 @@
+import asyncio
+
+import pytest
+
+from async_bing_client.breaker import CircuitBreaker, CircuitOpenError, CLOSED, HALF_OPEN, OPEN
+
+
+def open_breaker(reset_timeout: float = 0.01) -> CircuitBreaker:
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=reset_timeout)
+    with pytest.raises(asyncio.TimeoutError):
+        with breaker.guard():
+            raise asyncio.TimeoutError()
+    assert breaker.state == OPEN
+    return breaker
+
+
+def test_cancelled_half_open_probe_frees_the_slot():
+    async def main():
+        breaker = open_breaker()
+        await asyncio.sleep(0.02)
+        assert breaker.state == HALF_OPEN
+
+        async def probe():
+            with breaker.guard():
+                await asyncio.sleep(10)
+
+        task = asyncio.create_task(probe())
+        await asyncio.sleep(0)
+        assert breaker.half_open_calls == 1
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+        assert breaker.state == HALF_OPEN
+        assert breaker.half_open_calls == 0
+        # 下一个试探请求仍然可以放行,成功后关闭
+        with breaker.guard():
+            pass
+        assert breaker.state == CLOSED
+
+    asyncio.run(main())
+
+
+def test_half_open_rejects_extra_probes():
+    breaker = open_breaker()
+    breaker.opened_at -= 1
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
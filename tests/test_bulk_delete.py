@@ -0,0 +1,25 @@
+from time import time
+
+
+def test_stale_ids_keep_existing_tokens(run):
+    async def test(client, session):
+        now = time()
+        client.chats = {
+            "c1": {"conversationId": "c1", "conversationSignature": "sig", "access_token": "t1", "time": now},
+            # 本地新建,还没出现在bing的会话列表中
+            "local": {"conversationId": "local", "conversationSignature": "sig", "access_token": "t2", "time": now},
+        }
+        results = await client.delete_conversations(["c2", "gone"])
+
+        assert [(result.conversation_id, result.success) for result in results] == [
+            ("c2", True),
+            ("gone", False),
+        ]
+        assert session.calls[("/sydney/DeleteSingleConversation", "c2")] == 1
+        assert client.chats["c1"]["access_token"] == "t1"
+        assert client.chats["c1"]["time"] == now
+        assert client.chats["local"]["access_token"] == "t2"
+        assert "c3" not in client.chats
+        assert "c2" not in client.chats
+
+    run(test)
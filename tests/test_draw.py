@@ -0,0 +1,78 @@
+import asyncio
+from time import monotonic
+
+from async_bing_client import Apology, Bing_Client, DrawCache, Image
+
+
+def make_client(calls: list, cancelled: list, **kwargs) -> Bing_Client:
+    client = Bing_Client("[]", **{"draw_cache": DrawCache(), **kwargs})
+
+    async def fake_draw(prompt, deadline=None):
+        calls.append(prompt)
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(prompt)
+            raise
+        return [Image(url=f"https://example.com/{prompt}")]
+
+    client._draw = fake_draw
+    return client
+
+
+def test_shared_draw_is_cancelled_with_its_last_waiter():
+    async def main():
+        calls, cancelled = [], []
+        client = make_client(calls, cancelled)
+        first = client.submit_draw("a cat")
+        second = client.submit_draw("A  Cat")
+        await asyncio.sleep(0.01)
+        assert calls == ["a cat"]
+
+        first.cancel()
+        await asyncio.sleep(0.01)
+        assert cancelled == []
+
+        second.cancel()
+        await asyncio.sleep(0.01)
+        assert cancelled == ["a cat"]
+        assert not client._draw_tasks
+        assert client._draw_semaphore._value == client.max_concurrent_draws
+        await client.aclose()
+
+    asyncio.run(main())
+
+
+def test_cancel_draws_cancels_shared_draws():
+    async def main():
+        calls, cancelled = [], []
+        client = make_client(calls, cancelled)
+        waiter = asyncio.ensure_future(client.draw("a dog"))
+        await asyncio.sleep(0.01)
+        client.cancel_draws()
+        await asyncio.sleep(0.01)
+        assert cancelled == ["a dog"]
+        assert waiter.cancelled()
+        await client.aclose()
+
+    asyncio.run(main())
+
+
+def test_draw_timeout_covers_waiting_for_a_slot():
+    async def main():
+        calls, cancelled = [], []
+        client = make_client(
+            calls, cancelled, draw_cache=None, max_concurrent_draws=1, draw_timeout=0.2
+        )
+        start = monotonic()
+        # 第二个画图要等第一个释放名额,等待的时间也计入draw_timeout
+        results = await asyncio.gather(client.draw("a cat"), client.draw("a dog"))
+        assert monotonic() - start < 0.5
+        assert all(isinstance(result, Apology) for result in results)
+        assert calls == ["a cat"]
+        assert cancelled == ["a cat"]
+        assert client._draw_semaphore._value == 1
+        assert client.breakers["images"].failures == 0
+        await client.aclose()
+
+    asyncio.run(main())
@@ -0,0 +1,51 @@
+import asyncio
+import json
+from io import BytesIO
+
+from aiohttp import web
+from PIL import Image as PILImage
+
+from async_bing_client import Bing_Client, Image
+
+COOKIES = json.dumps([{"name": "_U", "value": "auth", "domain": ".bing.com"}])
+
+
+def png() -> bytes:
+    outfile = BytesIO()
+    PILImage.new("RGB", (8, 8)).save(outfile, format="PNG")
+    return outfile.getvalue()
+
+
+async def start_server():
+    async def image(request):
+        response = web.Response(body=png(), content_type="image/png")
+        response.set_cookie("_U", "evil")
+        response.set_cookie("MUID", "tracker")
+        return response
+
+    app = web.Application()
+    app.router.add_get("/image.png", image)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    # CookieJar不接受来自ip地址的cookie,这里用域名访问
+    return runner, f"http://localhost:{port}/image.png"
+
+
+def test_image_downloads_do_not_touch_the_cookie_jar():
+    async def main():
+        runner, url = await start_server()
+        client = Bing_Client(COOKIES)
+        try:
+            images = await client.download_images([Image(url=url)])
+            assert images[0].base64
+            assert [(cookie.key, cookie.value) for cookie in client.cookie_jar] == [("_U", "auth")]
+            # 和client.session共用连接池
+            assert client.image_session.connector is client.session.connector
+        finally:
+            await client.aclose()
+            await runner.cleanup()
+
+    asyncio.run(main())
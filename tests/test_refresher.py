@@ -0,0 +1,20 @@
+import asyncio
+from time import time
+
+from async_bing_client import Bing_Client
+
+
+def test_chats_are_not_tracked_without_refresh_tokens():
+    async def main():
+        client = Bing_Client("[]")
+        for i in range(100):
+            chat_data = {
+                "conversationId": f"c{i}",
+                "conversationSignature": "sig",
+                "time": time(),
+            }
+            await client.ensure_token({f"c{i}": chat_data})
+        assert not client.token_refresher._active
+        await client.aclose()
+
+    asyncio.run(main())
@@ -0,0 +1,93 @@
+import asyncio
+
+from async_bing_client.utils import SingleFlight
+
+# 和conftest.FakeSession返回的会话列表相同
+CHATS = ["c1", "c2", "c3"]
+
+
+def test_concurrent_get_chats(run):
+    async def test(client, session):
+        await asyncio.gather(*[client.get_chats() for _ in range(100)])
+        assert session.calls == {("/turing/conversation/chats", None): 1}
+
+    run(test)
+
+
+def test_concurrent_get_token(run):
+    async def test(client, session):
+        await asyncio.gather(*[client.get_token(cid) for cid in CHATS * 50])
+        assert session.calls == {("/turing/conversation/create", cid): 1 for cid in CHATS}
+        assert all(client.chats[cid]["access_token"] == "token" for cid in CHATS)
+
+    run(test)
+
+
+def test_concurrent_get_chat_history(run):
+    async def test(client, session):
+        client.chats = {cid: {"conversationId": cid} for cid in CHATS}
+        await asyncio.gather(*[client.get_chat_history(cid) for cid in CHATS * 50])
+        assert session.calls == {("/sydney/GetConversation", cid): 1 for cid in CHATS}
+
+    run(test)
+
+
+def test_concurrent_deletes_reload_once(run):
+    async def test(client, session):
+        loads = 0
+        load_all_chats = client.load_all_chats
+
+        async def counting_load_all_chats(*args, **kwargs):
+            nonlocal loads
+            loads += 1
+            return await load_all_chats(*args, **kwargs)
+
+        client.load_all_chats = counting_load_all_chats
+        results = await asyncio.gather(
+            *[client.delete_conversation(f"unknown{i}") for i in range(100)],
+            return_exceptions=True,
+        )
+        assert all(str(result) == "The conversation didn't exist" for result in results)
+        assert loads == 1
+        assert session.calls[("/turing/conversation/chats", None)] == 1
+        assert all(session.calls[("/turing/conversation/create", cid)] == 1 for cid in CHATS)
+
+    run(test)
+
+
+def test_single_flight_shares_exceptions():
+    async def main():
+        flights = SingleFlight()
+        calls = 0
+
+        async def fail():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            raise ValueError("boom")
+
+        results = await asyncio.gather(
+            *[flights.do("key", fail) for _ in range(10)], return_exceptions=True
+        )
+        assert calls == 1
+        assert all(isinstance(result, ValueError) for result in results)
+        assert len(flights) == 0
+
+    asyncio.run(main())
+
+
+def test_cancelled_waiter_does_not_cancel_the_call():
+    async def main():
+        flights = SingleFlight()
+
+        async def work():
+            await asyncio.sleep(0.02)
+            return 42
+
+        first = asyncio.ensure_future(flights.do("key", work))
+        second = asyncio.ensure_future(flights.do("key", work))
+        await asyncio.sleep(0)
+        first.cancel()
+        assert await second == 42
+
+    asyncio.run(main())
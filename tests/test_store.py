@@ -0,0 +1,57 @@
+import asyncio
+
+import pytest
+
+from async_bing_client import JSONChatStore, SQLiteChatStore
+
+
+@pytest.fixture(params=["sqlite", "json"])
+def make_store(request, tmp_path):
+    def make():
+        if request.param == "sqlite":
+            return SQLiteChatStore(tmp_path / "chats.db")
+        return JSONChatStore(tmp_path / "chats.jsonl")
+
+    return make
+
+
+def chat(conversation_id: str) -> dict:
+    return {conversation_id: {"conversationId": conversation_id, "time": 1}}
+
+
+def test_replace_without_load_removes_stale_chats(make_store):
+    async def main():
+        store = make_store()
+        await store.replace_chats("client", {**chat("a"), **chat("b")})
+        await store.close()
+
+        # 重新打开后没有调用load,直接用最新的会话列表替换
+        store = make_store()
+        await store.replace_chats("client", chat("a"))
+        await store.close()
+
+        store = make_store()
+        client_id, chats = await store.load()
+        await store.close()
+        assert client_id == "client"
+        assert list(chats) == ["a"]
+
+    asyncio.run(main())
+
+
+def test_delete_without_load(make_store):
+    async def main():
+        store = make_store()
+        await store.put_chat("a", chat("a")["a"])
+        await store.close()
+
+        store = make_store()
+        await store.delete_chat("a")
+        await store.close()
+
+        store = make_store()
+        _, chats = await store.load()
+        await store.close()
+        assert chats == {}
+
+    asyncio.run(main())